@@ -0,0 +1,213 @@
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import tb
+
+# Every workload is a program built to stress one path of the interpreter.
+# It is run headless: no INPUT and its output thrown away. The statements of
+# a run are counted once with RUN PROFILE, then the best time of a few runs
+# gives the statements per second and one more run under tracemalloc the
+# peak memory.
+
+def forLoop():
+    # a tight FOR loop of arithmetic
+    return """10 LET x = 0
+20 FOR i = 1 TO 100000
+30 LET x = x + i * 2 - 1
+40 NEXT i
+50 PRINT x
+"""
+
+def fibonacci():
+    # deep GOSUB recursion, the arguments passed in the registers
+    return """10 STA 22
+20 GOSUB 100
+30 LDA f
+40 PRINT f
+50 END
+100 LDA n
+110 IF n < 2 THEN RETURN
+120 STA n - 1
+130 GOSUB 100
+140 LDA a
+150 STA n - 2
+160 GOSUB 100
+170 LDA b
+180 STA a + b
+190 RETURN
+"""
+
+def strings():
+    # a string built up with . one piece at a time
+    return """10 LET s$ = ""
+20 FOR i = 1 TO 20000
+30 LET s$ = s$ . "ab" . i
+40 NEXT i
+50 PRINT s$
+"""
+
+def expressions():
+    # deep parentheses and many operators in one line
+    return """10 LET a = 3
+20 LET b = 7
+30 FOR i = 1 TO 20000
+40 LET x = ((((a + b) * (a - b)) / ((a * 2) + (b * 3))) ^ 2 + ((i % 7) * ((a + 1) * (b - 1)))) - (((a * b) + (a / b)) * ((b - a) + (i / 3)))
+50 LET y = ((x > 0) & (x < 1000000)) | ((a == b) & !(b != a))
+60 NEXT i
+70 PRINT x . " " . y
+"""
+
+def sparse():
+    # a jump over a wide gap of line numbers, 10 and 1000000
+    return """10 LET i = 0
+20 LET i = i + 1
+30 IF i < 50000 THEN GOTO 1000000
+40 PRINT i
+50 END
+1000000 GOTO 20
+"""
+
+workloads = {
+    "for": forLoop,
+    "fibonacci": fibonacci,
+    "strings": strings,
+    "expressions": expressions,
+    "sparse": sparse,
+    "loadsave": None # see loadSave()
+}
+
+saveLines = 100000
+
+def newInterpreter():
+    interpreter = tb.Interpreter(output = open(os.devnull, "w"))
+    interpreter.bufferSize = 1 << 16
+    return interpreter
+
+def runProgram(interpreter, text, fast):
+    interpreter.load(text)
+    error = interpreter.run(inputs = [], fast = fast)
+    if error != None:
+        raise tb.BasicError(f"Workload stopped: {error}")
+
+def countStatements(text):
+    interpreter = newInterpreter()
+    interpreter.load(text)
+    interpreter.run(inputs = [], profiled = True)
+    return sum(stats[0] for stats in interpreter.lineProfile.values())
+
+def loadSave(interpreter, directory):
+    # LOAD a large file without its .tbc, then SAVE it, a statement per line
+    filename = os.path.join(directory, "big.tb")
+    if not(os.path.isfile(filename)):
+        with open(filename, 'w') as f:
+            for i in range(1, saveLines + 1):
+                f.write(f"{i * 10} LET x{i % 100} = x{i % 100} + {i} * 2 . \"text {i}\"\n")
+    copy = os.path.join(directory, "copy.tb")
+    if os.path.isfile(copy):
+        os.remove(copy)
+    interpreter.useCache = False
+    interpreter.loadHandler([[filename, "STRING"]])
+    interpreter.saveHandler([[copy, "STRING"]])
+    interpreter.flushOutput()
+    return 2 * saveLines
+
+def measure(name, fast, repeat, directory):
+    # gives the report of one workload
+    if name == "loadsave":
+        job = lambda interpreter: loadSave(interpreter, directory)
+        statements = job(newInterpreter()) # also writes the file
+    else:
+        text = workloads[name]()
+        job = lambda interpreter: runProgram(interpreter, text, fast)
+        statements = countStatements(text)
+    best = None
+    for i in range(repeat):
+        interpreter = newInterpreter()
+        gc.collect()
+        start = time.perf_counter()
+        job(interpreter)
+        seconds = time.perf_counter() - start
+        if best == None or seconds < best:
+            best = seconds
+    interpreter = newInterpreter()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        job(interpreter)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "statements": statements,
+        "time": best,
+        "rate": statements / best,
+        "peak": peak
+    }
+
+def compare(results, baseline, threshold):
+    # gives the lines to show for every workload that got slower or bigger
+    # than the baseline by more than threshold
+    regressions = []
+    for name, result in results.items():
+        old = baseline["workloads"].get(name)
+        if old == None:
+            continue
+        if result["rate"] < old["rate"] * (1 - threshold):
+            regressions.append(f"{name}: {result['rate']:,.0f} statements/s, was {old['rate']:,.0f}")
+        # a few KiB either way is only noise
+        if result["peak"] > old["peak"] * (1 + threshold) + 64 * 1024:
+            regressions.append(f"{name}: {result['peak'] / 1024:,.0f} KiB peak, was {old['peak'] / 1024:,.0f}")
+    return regressions
+
+def main(args):
+    parser = argparse.ArgumentParser(prog = "bench.py", description = "Benchmark the Tiny BASIC interpreter.")
+    parser.add_argument("workload", nargs = "*",
+        help = f"workloads to run, all of them when none is given: {', '.join(workloads)}")
+    parser.add_argument("--fast", action = "store_true", help = "run the programs like RUN FAST")
+    parser.add_argument("--repeat", type = int, default = 3, metavar = "N", help = "runs timed, the best one counts")
+    parser.add_argument("--baseline", metavar = "FILE", help = "compare with the results saved in FILE")
+    parser.add_argument("--save", metavar = "FILE", help = "save the results to FILE as the next baseline")
+    parser.add_argument("--threshold", type = float, default = 0.1,
+        help = "how much slower or bigger than the baseline is a regression, 0.1 is 10%%")
+    options = parser.parse_args(args)
+    names = options.workload if len(options.workload) != 0 else list(workloads)
+    for name in names:
+        if name not in workloads:
+            parser.error(f"unknown workload {name}")
+    results = {}
+    print(f"{'workload':<12} {'statements':>10} {'time':>9} {'statements/s':>13} {'peak KiB':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            result = results[name] = measure(name, options.fast, max(options.repeat, 1), directory)
+            print(f"{name:<12} {result['statements']:>10} {result['time']:>8.3f}s "
+                f"{result['rate']:>13,.0f} {result['peak'] / 1024:>9,.0f}", flush = True)
+    report = {
+        "python": platform.python_version(),
+        "fast": options.fast,
+        "workloads": results
+    }
+    status = 0
+    if options.baseline != None:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get("python") != report["python"] or baseline.get("fast") != report["fast"]:
+            print(f"Note: the baseline was taken with Python {baseline.get('python')}"
+                f"{' with' if baseline.get('fast') else ' without'} --fast.")
+        regressions = compare(results, baseline, options.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if len(regressions) != 0:
+            status = 1
+    if options.save != None:
+        with open(options.save, 'w') as f:
+            json.dump(report, f, indent = 2)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,36 @@
+import io
 import os
+import re
 import sys
+import gc
+import csv
+import glob
+import json
+import shutil
 import math
+import marshal
+import hashlib
+import time
+import bisect
+import queue
+import threading
+from array import array
+import argparse
+import multiprocessing
 import platform
 import traceback
+import operator
+from itertools import repeat
+from collections import OrderedDict
 from getch import getch
+try:
+    import numpy
+except ImportError: # MAT works on plain arrays without it
+    numpy = None
 
 VERSION = 2
+# .tbc files are only read by the VERSION and Python that wrote them
+cacheKey = f"tbc {VERSION} {sys.implementation.cache_tag}"
 
 math_functions = {
     "COS": math.cos,
@@ -38,15 +63,14 @@ reserved = [
     "SLEEP", "END", "LIST", "REM", "READ",
     "WRITE", "APPEND", "RUN", "CLS", "CLEAR",
     "EXIT", "LOAD", "SAVE", "THEN", "ELSE",
-    "FOR", "TO", "DO", "GOSUB", "RETURN",
-    "STA", "STS", "STT", "LDA", "LDS", "LDT", "DIR"
+    "FOR", "TO", "DO", "GOSUB", "RETURN", "STEP", "NEXT",
+    "STA", "STS", "STT", "LDA", "LDS", "LDT", "DIR", "FLUSH",
+    "PROFILE", "DIM", "MAT", "MEMO"
 ]
 
-registers = {
-    "A": 0,
-    "S": 0,
-    "T": 0,
-}
+# REM and the reserved words that do nothing on their own, RUN skips lines
+# starting with one of them
+silentWords = {"REM", "THEN", "ELSE", "TO", "STEP", "DO", "SLEEP", "READ", "WRITE", "APPEND"}
 
 operators = [
     ["==", "!=", ">", "<", ">=", "<="],
@@ -64,15 +88,7 @@ constants = {
     "TAU": math.tau,
 }
 
-lines = {}
-maxLine = 0
-linePointer = 0
-stopExecution = False
-# change identifiers to be a list of set, in order to call subroutine
-identifiers = [{}]
-returnPos = []
-printReady = True
-
+unset = object() # stands for a slot that is not set in a scope
 commands = [""]
 currentCommand = 0
 
@@ -134,19 +150,21 @@ def getInput():
             ss = ss + c
 
 def main():
-    global stopExecution
+    interpreter = Interpreter()
+    if sys.stdout.isatty(): # show PRINT on a terminal as soon as it runs
+        interpreter.bufferSize = 0
+        interpreter.pageSize = max(shutil.get_terminal_size().lines - 1, 1)
     print(f"Tiny BASIC version {VERSION}\nby Jeffrey Chen")
     print("\n<Based on Tiny BASIC version 1 by Chung-Yuan Huang>\n")
     while True:
             try:
-                if printReady:
+                if interpreter.printReady:
                     # not a bug fixed, just prefer this way
                     print("\>", end = " ", flush = True)
                 nextLine = getInput()
                 if len(nextLine) > 0:
-                    executeTokens(lex(nextLine))
                     # bug fixed: reset stopExecution when a command is done
-                    stopExecution = False
+                    interpreter.execute(nextLine)
             except KeyboardInterrupt:
                 pass
             except EOFError:
@@ -166,21 +184,354 @@ def main():
                 errMsg = "File \"{}\", line {}, in {}: [{}] {}".format(fileName, lineNum, funcName, error_class, detail)
                 print("\nExecution halted:\n"+errMsg)
 
-def clearLines(): # clear all codes
-    global lines, maxLine
-    lines = {}
-    maxLine = 0
-
-def resetExcution(): # reset all variables and registers
-    global identifiers, returnPos, registers
-    identifiers = [{}]
-    returnPos = []
-    registers = {
-        "A": 0,
-        "S": 0,
-        "T": 0,
+def addLimitOptions(parser):
+    parser.add_argument("--fast", action = "store_true", help = "run it like RUN FAST")
+    parser.add_argument("--max-statements", type = int, default = 0, metavar = "N",
+        help = "stop after N statements")
+    parser.add_argument("--max-time", type = float, default = 0, metavar = "SECONDS",
+        help = "stop after SECONDS of running")
+    parser.add_argument("--max-depth", type = int, default = 10000, metavar = "N",
+        help = "deepest GOSUB nesting, 0 for no limit")
+    parser.add_argument("--max-string", type = int, default = 0, metavar = "SIZE",
+        help = "most characters all string variables may hold")
+
+def setLimits(interpreter, options):
+    interpreter.maxStatements = max(options.max_statements, 0)
+    interpreter.maxTime = max(options.max_time, 0)
+    interpreter.maxDepth = max(options.max_depth, 0)
+    interpreter.maxStringSize = max(options.max_string, 0)
+
+def exitStatus(lastError):
+    # 0 when a run got to the end, 3 when it hit a limit and 1 for any other error
+    if lastError == None:
+        return 0
+    return 3 if isinstance(lastError, LimitError) else 1
+
+def runFile(args):
+    # run a program file without the prompt: INPUT reads lines from stdin and
+    # the exit status is 0 when it ran to the end, 1 when it stopped on an
+    # error, 2 when it could not be loaded or a file of its options could not
+    # be read or written and 3 when it hit a limit
+    interpreter = Interpreter()
+    parser = argparse.ArgumentParser(prog = "tb.py", description = "Run a Tiny BASIC program.")
+    parser.add_argument("program", help = "program file, .tb is added when there is no extension")
+    parser.add_argument("--time", action = "store_true", help = "show the run time on stderr")
+    parser.add_argument("--quiet", action = "store_true", help = "discard everything the program prints")
+    parser.add_argument("--buffer", type = int, default = interpreter.bufferSize, metavar = "SIZE",
+        help = "characters of output kept before they are written, 0 writes at once")
+    parser.add_argument("--no-cache", action = "store_true", help = "don't read or write the .tbc file")
+    parser.add_argument("--profile", metavar = "FILE",
+        help = "run it like RUN PROFILE and save the profile, as JSON when FILE ends in .json, else CSV")
+    parser.add_argument("--trace", metavar = "FILE",
+        help = "log every line run, variable written, GOSUB, RETURN and INPUT to FILE")
+    parser.add_argument("--replay", metavar = "FILE",
+        help = "run it again with the INPUT lines of a trace instead of stdin")
+    addLimitOptions(parser)
+    options = parser.parse_args(args)
+    interpreter.bufferSize = max(options.buffer, 0)
+    interpreter.useCache = not(options.no_cache)
+    setLimits(interpreter, options)
+    # a program that can't be loaded, a directory or a binary file among
+    # them, is reported even with --quiet
+    if not(interpreter.loadHandler([[options.program, "STRING"]])):
+        interpreter.flushOutput()
+        return 2
+    if options.quiet:
+        interpreter.flushOutput()
+        interpreter.output = open(os.devnull, "w")
+    inputs = None
+    if options.replay != None:
+        try:
+            digest, inputs = readTrace(options.replay)
+        except (OSError, ValueError) as e:
+            print(f"Error: Cannot read trace {options.replay}: {e}.", file = sys.stderr)
+            return 2
+        if digest != interpreter.programDigest():
+            print(f"Note: {options.program} changed since the trace was written.", file = sys.stderr)
+    if options.trace != None:
+        try:
+            open(options.trace, 'w').close()
+        except OSError as e:
+            print(f"Error: Cannot write trace {options.trace}: {e.strerror}.", file = sys.stderr)
+            return 2
+    start = time.perf_counter()
+    lastError = interpreter.run(inputs, fast = options.fast, profiled = options.profile != None, trace = options.trace)
+    if options.time:
+        print(f"{time.perf_counter() - start:.6f} s", file = sys.stderr)
+    if options.profile != None:
+        try:
+            interpreter.saveProfile(options.profile)
+        except OSError as e:
+            print(f"Error: Cannot write {options.profile}: {e.strerror}.", file = sys.stderr)
+            return 2
+    return exitStatus(lastError)
+
+# what the workers of a pool run, set in every worker by startBatch() or
+# startSweep(): the programs of a batch, or the interpreter a sweep runs
+# again and again, and the options they run with
+batchPrograms = []
+sweepInterpreter = None
+sweepLines = []
+sweepReload = False
+jobOptions = None
+
+def jobInterpreter(options):
+    interpreter = Interpreter()
+    setLimits(interpreter, options)
+    if options.timeout > 0:
+        interpreter.maxTime = options.timeout
+    return interpreter
+
+def runJob(interpreter, inputs):
+    # run the loaded program once with INPUT reading inputs, gives the report
+    # of the run
+    output = io.StringIO()
+    interpreter.output = output
+    start = time.perf_counter()
+    try:
+        lastError = interpreter.run(inputs, jobOptions.fast)
+    except Exception as e:
+        # a failure of the interpreter itself only fails this run, it would
+        # stop the whole pool when it got back to the parent, and a sweep
+        # runs the same interpreter again so it must not stay mid-run
+        lastError = interpreter.lastError = BasicError(f"Internal error: {e!r}")
+        interpreter.resetExcution()
+    return {
+        "status": exitStatus(lastError),
+        "error": None if lastError == None else str(lastError),
+        "timeout": isinstance(lastError, LimitError) and lastError.limit == "time",
+        "output": output.getvalue(),
+        "time": time.perf_counter() - start,
+    }
+
+def startBatch(programs, options):
+    global batchPrograms, jobOptions
+    batchPrograms = programs
+    jobOptions = options
+
+def runBatchJob(index):
+    # run one program of the batch in a fresh interpreter, gives its report
+    # (lines is the error message of a program that could not be read)
+    filename, lines, inputs = batchPrograms[index]
+    interpreter = jobInterpreter(jobOptions)
+    report = {"program": filename, "input": inputs[0] if inputs else None}
+    try:
+        if isinstance(lines, str):
+            raise BasicError(lines)
+        interpreter.loadTokens(lines)
+    except BasicError as e:
+        report.update(status = 2, error = str(e), timeout = False, output = "", time = 0.0)
+        return report
+    except Exception as e:
+        report.update(status = 2, error = f"Internal error: {e!r}", timeout = False, output = "", time = 0.0)
+        return report
+    report.update(runJob(interpreter, inputs[1] if inputs else []))
+    return report
+
+def startSweep(lines, options):
+    # compile the program once for all the runs of this worker
+    global sweepInterpreter, sweepLines, sweepReload, jobOptions
+    jobOptions = options
+    sweepLines = lines
+    sweepInterpreter = jobInterpreter(options)
+    sweepInterpreter.loadTokens(lines)
+    # a program that edits itself while it runs needs a fresh copy every time
+    sweepReload = any(changesProgram(sweepInterpreter.getLine(i).statement) for i in sweepInterpreter.lineNumbers)
+
+def runSweepJob(job):
+    index, inputs = job
+    if sweepReload:
+        sweepInterpreter.loadTokens(sweepLines)
+    report = {"index": index, "inputs": inputs}
+    report.update(runJob(sweepInterpreter, inputs))
+    return report
+
+def findPrograms(paths):
+    # the .tb files of every directory and the files matched by every pattern
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(glob.glob(os.path.join(path, "*.tb")))
+        else:
+            found += sorted(glob.glob(path))
+    return found
+
+def addPoolOptions(parser):
+    parser.add_argument("--jobs", type = int, default = os.cpu_count(), metavar = "N", help = "processes to run on")
+    parser.add_argument("--timeout", type = float, default = 0, metavar = "SECONDS", help = "time allowed for each run")
+    parser.add_argument("--report", metavar = "FILE", help = "write the JSON lines to FILE instead of stdout")
+    addLimitOptions(parser)
+
+def writeReports(results, filename):
+    # write each report as a JSON line as soon as it comes, the exit status is
+    # 1 when any run did not get to the end
+    report = sys.stdout if filename == None else open(filename, 'w')
+    failed = False
+    for result in results:
+        failed = failed or result["status"] != 0
+        report.write(json.dumps(result) + "\n")
+        report.flush()
+    if report != sys.stdout:
+        report.close()
+    return 1 if failed else 0
+
+# a run gets this much longer than --timeout to stop itself before the
+# parent stops it, in seconds
+timeoutGrace = 1.0
+
+def stuckReport(seconds):
+    # the report of a run stopped from the parent, what it printed is lost
+    # with its worker
+    return {
+        "status": 3,
+        "error": f"{LimitError.messages['time']}.",
+        "timeout": True,
+        "output": "",
+        "time": seconds,
     }
 
+def poolResults(processes, initializer, initargs, function, jobs, timeout, report, chunks = 1):
+    # the results of function on every job in the order of the jobs, like
+    # Pool.imap, but a run stuck in one statement never gets to its own time
+    # limit: with a timeout a job is only given to an idle worker, and when
+    # it still runs timeoutGrace past the timeout the pool is stopped with
+    # it, report(job, seconds) stands for its result and the other runs
+    # start over on a new pool, chunks is the number of jobs in each task
+    # without a timeout
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        if timeout <= 0:
+            yield from pool.imap(function, jobs, chunks)
+            return
+        jobs = iter(jobs)
+        pending = [] # [job, result, start] in job order, result None once stopped
+        more = True
+        while True:
+            running = [entry for entry in pending if entry[1] != None and not(entry[1].ready())]
+            while more and len(running) < processes and len(pending) < 16 * processes:
+                job = next(jobs, None)
+                if job == None:
+                    more = False
+                    break
+                entry = [job, pool.apply_async(function, (job,)), time.perf_counter()]
+                pending.append(entry)
+                running.append(entry)
+            if len(pending) == 0:
+                return
+            job, result, start = pending[0]
+            if result == None: # start is now how long it ran
+                pending.pop(0)
+                yield report(job, start)
+                continue
+            if result.ready():
+                pending.pop(0)
+                yield result.get()
+                continue
+            now = time.perf_counter()
+            if not(any(now - entry[2] >= timeout + timeoutGrace for entry in running)):
+                # now and then to hand out the jobs of the workers done meanwhile
+                result.wait(0.05)
+                continue
+            # the late runs are stopped, the others lose their worker too
+            pool.terminate()
+            pool = multiprocessing.Pool(processes, initializer, initargs)
+            for entry in running:
+                if entry[1].ready():
+                    continue
+                if now - entry[2] >= timeout + timeoutGrace:
+                    entry[1] = None
+                    entry[2] = now - entry[2]
+                else:
+                    entry[1] = pool.apply_async(function, (entry[0],))
+                    entry[2] = now
+    finally:
+        pool.terminate()
+
+def runBatch(args):
+    # run many programs on a pool of processes and write one JSON line about
+    # each, in the order of the programs: the program is lexed once here and
+    # handed to the workers as tokens, the exit status is 1 when any of them
+    # did not run to the end
+    parser = argparse.ArgumentParser(prog = "tb.py --batch", description = "Run many Tiny BASIC programs.")
+    parser.add_argument("paths", nargs = "+", metavar = "PATH", help = "directory of .tb files or a glob pattern")
+    parser.add_argument("--inputs", metavar = "DIR",
+        help = "where the input of each program is, name.in for name.tb (next to the program by default)")
+    addPoolOptions(parser)
+    options = parser.parse_args(args)
+    programs = []
+    for filename in findPrograms(options.paths):
+        try:
+            with open(filename, 'r') as f:
+                lines = [lex(line.strip()) for line in f]
+        except OSError as e:
+            lines = f"Cannot read {filename}: {e.strerror}."
+        except UnicodeDecodeError:
+            lines = f"Cannot read {filename}: not a text file."
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        inputName = os.path.join(options.inputs or os.path.dirname(filename), stem + ".in")
+        inputs = None
+        if os.path.isfile(inputName):
+            with open(inputName, 'r') as f:
+                inputs = (inputName, f.read().splitlines())
+        programs.append((filename, lines, inputs))
+    def stuck(index, seconds):
+        filename, lines, inputs = programs[index]
+        report = {"program": filename, "input": inputs[0] if inputs else None}
+        report.update(stuckReport(seconds))
+        return report
+    results = poolResults(max(options.jobs, 1), startBatch, (programs, options),
+        runBatchJob, range(len(programs)), options.timeout, stuck)
+    return writeReports(results, options.report)
+
+def readVectors(filename):
+    # the inputs of each run: a JSON list per line for .jsonl files, else a
+    # CSV row, every value one line for INPUT
+    with open(filename, 'r', newline = '') as f:
+        if filename.lower().endswith((".jsonl", ".json")):
+            for line in f:
+                if line.strip():
+                    yield [value if isinstance(value, str) else str(value) for value in json.loads(line)]
+        else:
+            for row in csv.reader(f):
+                yield row
+
+def runSweep(args):
+    # run one program once for every input vector on a pool of processes,
+    # each worker compiles it once, the reports come out in the order of the
+    # vectors
+    parser = argparse.ArgumentParser(prog = "tb.py --sweep", description = "Run a Tiny BASIC program on many inputs.")
+    parser.add_argument("program", help = "program file, .tb is added when there is no extension")
+    parser.add_argument("vectors", help = "CSV file with the inputs of a run on each row, or JSON lines of lists")
+    addPoolOptions(parser)
+    options = parser.parse_args(args)
+    filename = options.program
+    if '.' not in filename:
+        filename = filename + '.tb'
+    try:
+        with open(filename, 'r') as f:
+            lines = [lex(line.strip()) for line in f]
+        Interpreter().loadTokens(lines) # only to report a bad program here
+    except OSError as e:
+        print(f"Error: Cannot read {filename}: {e.strerror}.")
+        return 2
+    except UnicodeDecodeError:
+        print(f"Error: Cannot read {filename}: not a text file.")
+        return 2
+    except BasicError as e:
+        print(f"Error: {e}")
+        return 2
+    except Exception as e: # the workers would fail to start over and over
+        print(f"Error: Internal error: {e!r}")
+        return 2
+    jobs = max(options.jobs, 1)
+    def stuck(job, seconds):
+        report = {"index": job[0], "inputs": job[1]}
+        report.update(stuckReport(seconds))
+        return report
+    results = poolResults(jobs, startSweep, (lines, options),
+        runSweepJob, enumerate(readVectors(options.vectors)), options.timeout, stuck, 16)
+    return writeReports(results, options.report)
+
 def is_number(s):
     try:
         float(s)
@@ -188,6 +539,14 @@ def is_number(s):
     except ValueError:
         return False
 
+def toNumber(s):
+    # the value of a number as written: whole numbers a float holds exactly
+    # are kept as int, see power()
+    value = float(s)
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return int(value)
+    return value
+
 def getVarType(token):
     if len(token) > 1:
         if token[-1] == "$":
@@ -208,751 +567,2478 @@ def isValidIdentifier(token):
             return False
     return True
     
+# a token is a string, a parenthesis or a word: words end at a space, a
+# quote or a parenthesis, a string runs to the next quote (one that is never
+# closed is dropped) and spaces only separate tokens
+tokenPattern = re.compile(r'"([^"]*)(")?|([()])|([^ "()]+)')
+reservedWords = set(reserved)
+operatorWords = {operator for level in operators for operator in level}
+# tokens of the words seen so far, most words come up again on every line
+wordTokens = {}
+
 def lex(line):
-    # Splitteo la linea en varios tokens  # split line into tokens
-    inString = False
+    # split line into tokens, each one a (value, type) tuple
+    if '"' not in line: # no strings, the words are all split by spaces
+        if "(" in line or ")" in line:
+            line = line.replace("(", " ( ").replace(")", " ) ")
+        return [wordTokens.get(word) or lexWord(word) for word in line.split(" ") if word]
     tokens = []
-    currentToken = ""
-    line = line + " "
-    for c in line:
-        if not(inString) and c in " \"":
-            if len(currentToken) != 0:
-                tokens.append([currentToken, "TBD"])   # To Be Decide?
-                currentToken = ""
-            if c == '"':
-                inString = True
-        elif inString and c == '"':
-            tokens.append([currentToken, "STRING"])
-            currentToken = ""
-            inString = False
-        # to make expressions like "(1 + 2) * 3" work
-        # parentesis don't have to separate with other tokens by spaces
-        elif not(inString) and  c in ['(', ')']:
-            if len(currentToken) != 0:
-                tokens.append([currentToken, "TBD"])
-                currentToken = ""
-            tokens.append([c, "PAREN"]) # parentesis
-        else:
-            currentToken += c
-
-    # Le asigno un tipo a cada token (assign a type to each token)
-    for token in tokens:
-        if token[1] != "TBD":
-            continue
-        value = token[0]
-        if is_number(value):
-            token[0] = float(token[0])
-            token[1] = "NUM" #Number
-        elif value.upper() in reserved:
-            token[0] = value.upper()
-            token[1] = "RESVD" #Reserved word
-        elif value in constants:
-            token[0] = constants[value.upper()]
-            token[1] = "NUM" #built-in constant
-        elif value == "=":
-            token[1] = "ASGN"
-        elif isValidIdentifier(token[0]) and token[0] not in math_functions:
-            token[1] = "ID" #Identifier
-        else:
-            for operator in operators:
-                if token[0] in operator:
-                    token[1] = "OP"
-    #print(tokens)
+    for text, closed, paren, word in tokenPattern.findall(line):
+        if word:
+            tokens.append(wordTokens.get(word) or lexWord(word))
+        elif paren:
+            tokens.append((paren, "PAREN")) # parentesis
+        elif closed:
+            tokens.append((text, "STRING"))
     return tokens
 
-def executeTokens(tokens):
-    global lines, maxLine, stopExecution, linePointer, printReady, identifiers, returnPos
-    printReady = True
-    if tokens[0][1] == "NUM":
-        lineNumber = int(tokens.pop(0)[0])
-        if len(tokens) != 0:
-            lines[lineNumber] = tokens
-            if lineNumber > maxLine:
-                maxLine = lineNumber
-        else:
-            lines.pop(lineNumber, None)
-        return
-    if tokens[0][1] != "RESVD":
-        # bug fixed: stopExecution when run into a non-reserved word
-        stopExecution = True
-        print(f"Error: Unknown command {tokens[0]}.")
+def lexWord(value):
+    # assign a type to a word
+    if value == "(" or value == ")":
+        token = (value, "PAREN") # parentesis
+    elif is_number(value):
+        token = (toNumber(value), "NUM") #Number
+    elif value.upper() in reservedWords:
+        token = (sys.intern(value.upper()), "RESVD") #Reserved word
+    elif value in constants:
+        token = (constants[value], "NUM") #built-in constant
+    elif value == "=":
+        token = (value, "ASGN")
+    elif isValidIdentifier(value) and value not in math_functions:
+        token = (sys.intern(value), "ID") #Identifier
+    elif value in operatorWords:
+        token = (value, "OP")
     else:
-        command = tokens[0][0]
-        if command == "REM":
-            return
-        elif command == "CLS":
-            print("\n"*500)
-        elif command == "END":
-            stopExecution = True
-        elif command == "EXIT":
-            quit()
-        elif command == "CLEAR":
-            clearLines()
-            resetExcution()
-        elif command == "DIR": # list all the variables and their values in the current scope
-            print(identifiers[0])
-        elif command == "LIST":
-            i = 0
-            while i <= maxLine:
-                if i in lines:
-                    line = str(i)
-                    for token in lines[i]:
-                        tokenVal = ""
-                        if token[1] == "NUM":
-                            tokenVal = getNumberPrintFormat(token[0])
-                        elif token[1] == "STRING":
-                            tokenVal = f"\"{token[0]}\""
-                        else:
-                            tokenVal = token[0]
-                        line += " " + str(tokenVal)
-                    print(line)
-                i = i + 1
-        elif command == "PRINT":
-            if not(printHandler(tokens[1:])): stopExecution = True
-        elif command == "LET":
-            if not(letHandler(tokens[1:])): stopExecution = True
-        elif command == "INPUT":
-            if not(inputHandler(tokens[1:])): stopExecution = True
-        elif command == "GOTO":
-            if not(gotoHandler(tokens[1:])): stopExecution = True
-        elif command == "IF":
-            if not(ifHandler(tokens[1:])): stopExecution = True
-        elif command == "FOR":
-            if not(forHandler(tokens[1:])): stopExecution = True
-        elif command == "RUN":
-            linePointer = 0
-            # bug fixed: clear identifiers before execution
-            resetExcution()
-            while linePointer <= maxLine:
-                if linePointer in lines:
-                    executeTokens(lines[linePointer])
-                    if stopExecution:
-                        stopExecution = False
-                        break
-                linePointer = linePointer + 1
-            # bug fixed: clear identifiers after execution
-            resetExcution()
-        elif command == "SAVE":
-            if not(saveHandler(tokens[1:])): stopExecution = True
-        elif command == "LOAD":
-            if not(loadHandler(tokens[1:])): stopExecution = True
-        elif command == "GOSUB":
-            if not(gosubHandler(tokens[1:])): stopExecution = True
-        elif command == "RETURN":
-            if len(tokens) != 1:
-                print("Error: Invalid return command.")
-                stopExecution = True
-            if not(returnHandler()): stopExecution = True
-        elif command == "STA":
-            if not(staHandler(tokens[1:])): stopExecution = True
-        elif command == "LDA":
-            if not(ldaHandler(tokens[1:])): stopExecution = True
-        elif command == "STS":
-            if not(stsHandler(tokens[1:])): stopExecution = True
-        elif command == "LDS":
-            if not(ldsHandler(tokens[1:])): stopExecution = True
-        elif command == "STT":
-            if not(sttHandler(tokens[1:])): stopExecution = True
-        elif command == "LDT":
-            if not(ldtHandler(tokens[1:])): stopExecution = True
+        token = (value, "TBD")
+    if len(wordTokens) >= 65536: # line numbers and constants keep coming
+        wordTokens.clear()
+    wordTokens[value] = token
+    return token
+
+class BasicError(Exception):
+    # raised while parsing or running a line, reported as "Error: ..."
+    pass
 
+class LoadError(BasicError):
+    # a program with lines that don't start with a line number, badLines
+    # holds where each one is in the text, counting from 1
+    def __init__(self, badLines):
+        if len(badLines) == 1:
+            super().__init__(f"Invalid line number in line {badLines[0]}.")
+        else:
+            super().__init__(f"Invalid line numbers in lines {', '.join(map(str, badLines))}.")
+        self.badLines = badLines
+
+class LimitError(BasicError):
+    # a run stopped by one of its limits, limit is "statements", "time",
+    # "depth" or "string"
+    messages = {
+        "statements": "Statement limit reached",
+        "time": "Time limit reached",
+        "depth": "Stack overflow",
+        "string": "String size limit reached",
+    }
+
+    def __init__(self, limit, lineNumber):
+        super().__init__(f"{LimitError.messages[limit]} at line {lineNumber}.")
+        self.limit = limit
+        self.lineNumber = lineNumber
+
+class Line:
+    # a stored line, the tokens are kept for LIST and SAVE while the
+    # statement is parsed and compiled once, when the line is entered (a
+    # loaded line keeps where it starts in the text instead of its tokens)
+    __slots__ = ("tokens", "statement", "code")
+
+    def __init__(self, tokens, statement, code):
+        self.tokens = tokens
+        self.statement = statement
+        self.code = code
+
+class Rope:
+    # the value of a string variable built by LET a$ = a$ . text, the pieces
+    # are only joined when the whole text is read, and every 64 small ones
+    # are joined into a part of their own to keep them from using more memory
+    # than the text
+    __slots__ = ("parts", "pieces", "size")
+
+    def __init__(self, text):
+        self.parts = [text]
+        self.pieces = []
+        self.size = len(text)
+
+    def append(self, text):
+        self.pieces.append(text)
+        self.size += len(text)
+        if len(self.pieces) == 64:
+            self.parts.append("".join(self.pieces))
+            self.pieces.clear()
+
+    def flatten(self):
+        if len(self.parts) != 1 or len(self.pieces) != 0:
+            self.parts = ["".join(self.parts) + "".join(self.pieces)]
+            self.pieces.clear()
+        return self.parts[0]
+
+def isAppend(target, tree):
+    # LET a$ = a$ . text
+    return (getVarType(target) == "STRING" and tree[0] == "OP" and tree[1] == "."
+        and tree[2] == ("ID", target))
+
+def lineText(lineNumber, tokens):
+    # a line the way LIST shows it and SAVE writes it
+    line = str(lineNumber)
+    for token in tokens:
+        if token[1] == "NUM":
+            line += " " + str(getNumberPrintFormat(token[0]))
+        elif token[1] == "STRING":
+            line += f" \"{token[0]}\""
+        else:
+            line += " " + str(token[0])
+    return line
 
 def getNumberPrintFormat(num):
+    if num.__class__ is int:
+        return num
     if int(num) == float(num):
         return int(num)
     return num
 
-def saveHandler(tokens):
-    global lines, maxLine, printReady
-    printReady = True
-    if len(tokens) != 1:
-        print("Error: Invalid arguments.")
-        return False
-    if tokens[0][1] != "STRING":
-        print("Error: Invalid filename.")
-        return False
-    filename = tokens[0][0]
-    # if file extension not specified, add .tb
-    if '.' not in filename:
-        filename = filename + '.tb'
-    # if the file already exists, ask the user if he wants to overwrite it
-    if os.path.isfile(filename):
-        overwrite = input(f"File {filename} already exists. Overwrite? (y/n)")
-        if overwrite.lower() != "y":
-            return False
-    with open(filename, 'w') as f:
-        # basicly copy from "LIST" command
-        for i in range(maxLine + 1):
-            if i in lines:
-                line = str(i)
-                for token in lines[i]:
-                    tokenVal = ""
-                    if token[1] == "NUM":
-                        tokenVal = getNumberPrintFormat(token[0])
-                    elif token[1] == "STRING":
-                        tokenVal = f"\"{token[0]}\""
-                    else:
-                        tokenVal = token[0]
-                    line += " " + str(tokenVal)
-                f.write(line + "\n")
-    return True
+def checkIdentifier(varName):
+    # names built by an expression are only known at run time
+    if not(isinstance(varName, str)) or not(isValidIdentifier(varName)):
+        raise BasicError(f"{varName} is not a valid identifier.")
+    return varName
 
-def loadHandler(tokens):
-    global lines, maxLine, printReady
-    printReady = True
-    if len(tokens) != 1:
-        print("Error: Invalid arguments.")
-        return False
-    if tokens[0][1] != "STRING":
-        print("Error: Invalid filename.")
-        return False
-    filename = tokens[0][0]
-    # if file extension not specified, add .tb
-    if '.' not in filename:
-        filename = filename + '.tb'
-    try:
-        with open(filename, 'r') as f:
-            # basicly copy from "if tokens[0][1] == "NUM":" in executeTokens()
-            clearLines()
-            for line in f:
-                tokens = lex(line.strip())
-                if len(tokens) == 0:
-                    continue
-                if tokens[0][1] == "NUM":
-                    lineNumber = int(tokens.pop(0)[0])
-                    if len(tokens) != 0:
-                        lines[lineNumber] = tokens
-                        if lineNumber > maxLine:
-                            maxLine = lineNumber
-                    else:
-                        lines.pop(lineNumber, None)
-                else:
-                    print("Error: Invalid line number.")
-                    return False
-    except FileNotFoundError:
-        print("Error: File not found.")
-        return False
-    return True
+# what the Python operators and math functions raise on numbers they can't
+# handle, reported like any other error of the line
+mathErrors = (ArithmeticError, ValueError, TypeError)
 
-def gotoHandler(tokens):
-    global linePointer
-    if len(tokens) == 0:
-        print("Error: Expected expression.")
-        return
-    newNumber = solveExpression(tokens, 0)
-    if newNumber[1] != "NUM":
-        print("Error: Line number expected.")
-    else:
-        linePointer = newNumber[0] - 1
-    return True
+def mathError(e):
+    if isinstance(e, TypeError): # complex numbers can't be compared
+        return BasicError("Operand type mismatch.")
+    return BasicError(f"Math error: {e}.")
 
-def gosubHandler(tokens):
-    global linePointer, identifiers, returnPos
-    if len(tokens) == 0:
-        print("Error: Expected expression.")
-        return
-    newNumber = solveExpression(tokens, 0)
-    if newNumber[1] != "NUM":
-        print("Error: Line number expected.")
-    else:
-        returnPos.insert(0, linePointer) # push current line number to stack
-        identifiers.insert(0, {}) # variable scope for subroutine
-        linePointer = newNumber[0] - 1 # jump to subroutine
-    return True
+def failing(message):
+    # a line that could not be compiled reports its error when it is run
+    def fail():
+        raise BasicError(message)
+    return fail
 
-def returnHandler():
-    global linePointer, identifiers, returnPos
-    if len(returnPos) == 0:
-        print("Error: Not in a subroutine.")
-        return
-    linePointer = returnPos.pop(0) # pop current line number from stack
-    identifiers.pop(0)
-    return True
+def findReserved(tokens, word):
+    for i in range(0, len(tokens)):
+        if tokens[i][1] == "RESVD" and tokens[i][0] == word:
+            return i
+    return None
 
-def inputHandler(tokens):
-    varName = None
+def parseLine(tokens):
+    # a line that cannot be parsed reports its error when it is run
     if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    elif len(tokens) == 1 and tokens[0][1] == "ID":
-        varName = tokens[0][0]
-    else:
-        varName = solveExpression(tokens, 0)[0]
-        if not(isValidIdentifier(varName)):
-            print(f"Error: {varName} is not a valid identifier.")
-            return
-    while True:
-        print("?", end = '')
-        varValue = input()
-        if getVarType(varName) == "STRING":
-            identifiers[0][varName] = [varValue, "STRING"]
-            break
-        else:
-            if is_number(varValue):
-                # bug fixed: varValue -> float(varValue)
-                identifiers[0][varName] = [float(varValue), "NUM"] 
-                break
-            else:
-                print("Try again.")
-    return True
+        return ("REM",)
+    try:
+        return parseStatement(tokens)
+    except BasicError as e:
+        return ("ERROR", str(e))
 
-def ifHandler(tokens):
-    thenPos = elsePos = None
-    for i in range(0, len(tokens)):
-        if tokens[i] == ["THEN", "RESVD"]: # THEN is change to be a reserved word
-            thenPos = i
-            break
-    for i in range(0, len(tokens)): # find the position of "ELSE"
-        if tokens[i] == ["ELSE", "RESVD"]:
-            elsePos = i
-            break
-    # if "THEN" is not found or "ELSE" is found before "THEN"
-    if thenPos == None or (elsePos and thenPos > elsePos): 
-        print("Error: Malformed IF statement.")
-        return
-    exprValue = solveExpression(tokens[0:thenPos], 0)
-    if exprValue == None:
-        return
-    elif exprValue[0] != 0:
-        if len(tokens[thenPos+1:elsePos]) == 0:
-            print("Error: Malformed IF statement.")
-            return      
-        executeTokens(tokens[thenPos+1:elsePos])
-    # if "ELSE" is found, and exprValue is False
-    # execute the expression after "ELSE"
-    elif elsePos: 
-        if len(tokens[elsePos+1:]) == 0:
-            print("Error: Malformed IF statement.")
-            return
-        executeTokens(tokens[elsePos+1:])
-    return True
+def parseStatement(tokens):
+    # turn the tokens of a line into a statement tuple, the command first,
+    # with every expression parsed into a tree by parseExpression()
+    if tokens[0][1] == "NUM":
+        return ("LINE", tokens)
+    if tokens[0][1] != "RESVD":
+        # bug fixed: stopExecution when run into a non-reserved word
+        raise BasicError(f"Unknown command {list(tokens[0])}.")
+    command = tokens[0][0]
+    tokens = tokens[1:]
+    if command in silentWords:
+        return ("REM",)
+    elif command in ["CLS", "END", "EXIT", "CLEAR", "DIR", "FLUSH"]:
+        return (command,)
+    elif command == "LIST":
+        return ("LIST",) + parseRange(tokens)
+    elif command == "DIM":
+        return parseDim(tokens)
+    elif command == "MAT":
+        return parseMat(tokens)
+    elif command == "RUN":
+        # RUN FAST runs the program on the machine, RUN PROFILE times it
+        mode = str(tokens[0][0]).upper() if len(tokens) != 0 else ""
+        return ("RUN", mode == "FAST", mode == "PROFILE")
+    elif command == "PRINT":
+        if len(tokens) == 0:
+            raise BasicError("Expected identifier.")
+        return ("PRINT", parseExpression(tokens))
+    elif command == "LET":
+        return parseLet(tokens)
+    elif command == "INPUT":
+        return ("INPUT", parseTarget(tokens))
+    elif command == "GOTO" or command == "GOSUB":
+        if len(tokens) == 0:
+            raise BasicError("Expected expression.")
+        return (command, parseExpression(tokens))
+    elif command == "RETURN":
+        if len(tokens) != 0:
+            raise BasicError("Invalid return command.")
+        return ("RETURN",)
+    elif command == "MEMO":
+        # MEMO line marks a subroutine, MEMO alone shows the hits and misses
+        return ("MEMO", parseExpression(tokens) if len(tokens) != 0 else None)
+    elif command == "IF":
+        return parseIf(tokens)
+    elif command == "FOR":
+        return parseFor(tokens)
+    elif command == "NEXT":
+        if len(tokens) == 0:
+            return ("NEXT", None)
+        if len(tokens) != 1 or tokens[0][1] != "ID":
+            raise BasicError("Malformed NEXT statement.")
+        return ("NEXT", tokens[0][0])
+    elif command in ["STA", "STS", "STT"]: # store number to a register
+        if len(tokens) == 0:
+            raise BasicError("Expected identifier.")
+        return ("ST", command[2], parseExpression(tokens))
+    elif command in ["LDA", "LDS", "LDT"]: # load number from a register
+        return ("LD", command[2], parseTarget(tokens))
+    elif command == "SAVE" or command == "LOAD" or command == "PROFILE":
+        return (command, tokens)
+    return ("REM",)
 
-def forHandler(tokens):
-    global identifiers
-    toPos = doPos = None
-    # find the position of "TO" and "DO"
-    for i in range(0, len(tokens)):
-        if tokens[i] == ["TO", "RESVD"]:
-            toPos = i
-            break
-    for i in range(0, len(tokens)):
-        if tokens[i] == ["DO", "RESVD"]:
-            doPos = i
-            break
-    if toPos == None or doPos == None or toPos > doPos:
-        print("Error: Malformed FOR statement.")
-        return 
-    # get a copy of iterator variable
-    iterVar = None
-    if getIdentifierValue(tokens[0][0]) != None:
-        iterVar = getIdentifierValue(tokens[0][0])
-    # set the iterator to the first value
-    executeTokens([["LET", "RESVD"]] + tokens[0:toPos])
-    # calculate the end value
-    endValue = solveExpression(tokens[toPos+1:doPos], 0)
-    if endValue == None:
-        return
-    if endValue[1] != "NUM":
-        print("Error: Expected number.")
-        return
-    endValue = endValue[0]
-    # execute the FOR statement
-    while getIdentifierValue(tokens[0][0])[0] <= endValue:
-        executeTokens(tokens[doPos+1:])
-        tokens[toPos - 1][0] += 1
-        executeTokens([["LET", "RESVD"]] + tokens[0:toPos])
-    # restore the iterator variable
-    if iterVar != None:
-        executeTokens([["LET", "RESVD"]] + tokens[0:toPos - 1] + [iterVar])
-    return True
+listRange = re.compile(r'(\d+)?(?:(-)(\d+)?)?')
+
+def parseRange(tokens):
+    # the first and last line of LIST, LIST 10, LIST 10-50, LIST 10- or
+    # LIST -50, None when there is no limit
+    text = "".join([str(getNumberPrintFormat(token[0])) if token[1] == "NUM" else str(token[0]) for token in tokens])
+    match = listRange.fullmatch(text)
+    if match == None:
+        raise BasicError("Invalid line range.")
+    first = None if match[1] == None else int(match[1])
+    last = None if match[3] == None else int(match[3])
+    if match[2] == None:
+        last = first
+    return (first, last)
+
+def parseDim(tokens):
+    # DIM a(size) or DIM a$(size)
+    if len(tokens) < 3 or tokens[0][1] != "ID" or tokens[1][0] != "(":
+        raise BasicError("Malformed DIM statement.")
+    if findMatchingClose(tokens, 1) != len(tokens) - 1:
+        raise BasicError("Malformed DIM statement.")
+    return ("DIM", tokens[0][0], parseExpression(tokens[2:-1]))
+
+def parseMat(tokens):
+    # MAT name = expression, see compileMat()
+    statement = parseLet(tokens)
+    if not(isinstance(statement[1], str)):
+        raise BasicError("Malformed MAT statement.")
+    return ("MAT", statement[1], statement[2])
 
-def letHandler(tokens):
-    varName = None
-    varValue = None
+def parseTarget(tokens):
+    # the variable written by LET, INPUT and LDA, LDS, LDT: a name, an
+    # expression tree that gives the name when it is run, or an array element
+    if len(tokens) == 0:
+        raise BasicError("Expected identifier.")
+    if len(tokens) == 1 and tokens[0][1] == "ID":
+        return tokens[0][0]
+    return parseExpression(tokens)
+
+def parseLet(tokens):
     eqPos = None
     for i in range(0, len(tokens)):
         if tokens[i][1] == "ASGN":
             eqPos = i
             break
     if eqPos == None:
-        print("Error: Malformed LET statement.")
-        return
-    if eqPos == 1 and tokens[0][1] == "ID":
-        varName = tokens[0][0]
+        raise BasicError("Malformed LET statement.")
+    target = parseTarget(tokens[0:eqPos])
+    if len(tokens[eqPos+1:]) == 0:
+        raise BasicError("Expected expression.")
+    return ("LET", target, parseExpression(tokens[eqPos+1:]))
+
+def parseIf(tokens):
+    thenPos = findReserved(tokens, "THEN") # THEN is change to be a reserved word
+    elsePos = findReserved(tokens, "ELSE")
+    # if "THEN" is not found or "ELSE" is found before "THEN"
+    if thenPos == None or (elsePos != None and thenPos > elsePos):
+        raise BasicError("Malformed IF statement.")
+    condition = parseExpression(tokens[0:thenPos])
+    thenTokens = tokens[thenPos+1:elsePos]
+    if len(thenTokens) == 0:
+        thenStatement = ("ERROR", "Malformed IF statement.")
     else:
-        if len(tokens[0:i]) == 0:
-            print("Error: Expected identifier.")
+        thenStatement = parseLine(thenTokens)
+    elseStatement = None
+    # if "ELSE" is found, the statement after it runs when the condition fails
+    if elsePos != None:
+        if len(tokens[elsePos+1:]) == 0:
+            elseStatement = ("ERROR", "Malformed IF statement.")
+        else:
+            elseStatement = parseLine(tokens[elsePos+1:])
+    return ("IF", condition, thenStatement, elseStatement)
+
+def parseFor(tokens):
+    # FOR i = start TO end [STEP step] DO statement, or without DO the loop
+    # runs the lines up to the matching NEXT
+    # find the position of "TO", "STEP" and "DO"
+    toPos = findReserved(tokens, "TO")
+    doPos = findReserved(tokens, "DO")
+    endPos = len(tokens) if doPos == None else doPos
+    stepPos = findReserved(tokens[0:endPos], "STEP")
+    if toPos == None or toPos > endPos or (stepPos != None and stepPos < toPos):
+        raise BasicError("Malformed FOR statement.")
+    let = parseLet(tokens[0:toPos])
+    if not(isinstance(let[1], str)) or (doPos != None and len(tokens[doPos+1:]) == 0):
+        raise BasicError("Malformed FOR statement.")
+    step = None
+    if stepPos != None:
+        step = parseExpression(tokens[stepPos+1:endPos])
+        endPos = stepPos
+    end = parseExpression(tokens[toPos+1:endPos])
+    body = None
+    if doPos != None:
+        body = parseLine(tokens[doPos+1:])
+    return ("FOR", let[1], let[2], end, step, body)
+
+def parseExpression(tokens, level = 0):
+    # build the tree the way the expression has always been evaluated: split
+    # at the first operator of the lowest level, the right side keeps that
+    # level (so operators of one level group to the right) and everything
+    # left of it moves on to the next level
+    #   ("NUM", value), ("STRING", value), ("ID", name)
+    #   ("OP", operator, left, right), left is None for ! and functions
+    #   ("ELEM", name, index) for an element of the array name
+    if len(tokens) == 0:
+        raise BasicError("Expected expression.")
+    if level == len(operators):
+        if len(tokens) > 1:
+            raise BasicError("Operator expected.")
+        if tokens[0][1] == "TREE": # an expression in parentheses
+            return tokens[0][0]
+        return (tokens[0][1], tokens[0][0])
+    leftSideValues = []
+    i = 0
+    while i < len(tokens):
+        if not(tokens[i][1] in ["OP", "NUM", "STRING", "ID", "PAREN", "TREE"]):
+            raise BasicError(f"Unknown operand {tokens[i][0]}")
+        elif tokens[i][1] == "PAREN":
+            # find the matching close parentheses
+            close = findMatchingClose(tokens, i)
+            if close == None:
+                raise BasicError("Unmatched parentheses.")
+            # parse the expression inside the parentheses
+            inside = parseExpression(tokens[i+1:close])
+            if len(leftSideValues) != 0 and leftSideValues[-1][1] == "ID": # an array element
+                leftSideValues[-1] = (("ELEM", leftSideValues[-1][0], inside), "TREE")
+            else:
+                leftSideValues.append((inside, "TREE"))
+            # continue to the next token
+            i = close
+        elif tokens[i][1] == "OP" and tokens[i][0] in operators[level]:
+            left = right = None
+            if len(leftSideValues) != 0:
+                left = parseExpression(leftSideValues, level)
+            if len(tokens[i+1:]) != 0:
+                right = parseExpression(tokens[i+1:], level)
+            if right == None:
+                raise BasicError("Operator expects value.")
+            # ! and math functions are unary operators
+            if tokens[i][0] == "!" and left != None:
+                raise BasicError("! is an unary operator.")
+            elif tokens[i][0] in math_functions and left != None:
+                raise BasicError("Function is unary operator.")
+            elif tokens[i][0] not in operators[-1] and left == None:
+                raise BasicError("Operator expects value.")
+            return ("OP", tokens[i][0], left, right)
+        else:
+            leftSideValues.append(tokens[i])
+        i += 1
+    return parseExpression(leftSideValues, level + 1)
+
+def findMatchingClose(tokens, openIndex):
+    openCount = 1
+    for i in range(openIndex + 1, len(tokens)):
+        if tokens[i][0] == "(":
+            openCount += 1
+        elif tokens[i][0] == ")":
+            openCount -= 1
+        if openCount == 0:
+            return i
+    return None
+
+numberTexts = {} # the text of whole numbers PRINT or . already turned into text
+
+def numberText(num):
+    text = numberTexts.get(num)
+    if text == None:
+        value = getNumberPrintFormat(num)
+        text = str(value)
+        if value.__class__ is int and len(numberTexts) < 65536:
+            numberTexts[num] = text
+    return text
+
+def numberToText(value):
+    return lambda: numberText(value())
+
+# NUM values stay int through + - * % ^ << >> while every operand is a
+# whole number, / and the math functions give floats. An int result past
+# the range of a float overflows like the float it replaces instead of
+# growing without bound: + - * and << give inf, ^ the usual math error.
+maxIntBits = 1024
+
+def intOverflow(value):
+    if value.__class__ is int and value.bit_length() > maxIntBits:
+        return math.inf if value > 0 else -math.inf
+    return value
+
+def add(left, right):
+    return intOverflow(left + right)
+
+def subtract(left, right):
+    return intOverflow(left - right)
+
+def multiply(left, right):
+    return intOverflow(left * right)
+
+def power(base, exponent):
+    # ^ with a negative exponent gives a float too
+    if base.__class__ is int and exponent.__class__ is int and exponent > 0 and base.bit_length() * exponent > maxIntBits:
+        return float(base) ** exponent
+    return base ** exponent
+
+def shiftLeft(value, count):
+    value = toInteger(value)
+    count = toInteger(count)
+    if value != 0 and count > 0 and value.bit_length() + count > maxIntBits:
+        return math.inf if value > 0 else -math.inf
+    return value << count
+
+def toIndex(value, length):
+    # an array index, a whole number from 0 to length - 1
+    if value.__class__ is not int:
+        try:
+            if isinstance(value, complex) or int(value) != value:
+                raise BasicError("Index must be a whole number.")
+        except (ValueError, OverflowError):
+            raise BasicError("Index must be a whole number.")
+        value = int(value)
+    if value < 0 or value >= length:
+        raise BasicError(f"Index {value} out of range.")
+    return value
+
+def toInteger(value):
+    # << and >> only work on whole numbers
+    if value.__class__ is int:
+        return value
+    if isinstance(value, complex) or int(value) != value:
+        raise BasicError("Operand type mismatch.")
+    return int(value)
+
+# MAT works on whole arrays at once: with numpy an array is looked at as
+# a numpy array without copying it, without numpy every operator maps over
+# the array('d') of the elements. Either way a value is a number or a vector.
+
+matOperators = {
+    "+": add, "-": subtract, "*": multiply,
+    "/": operator.truediv, "^": power, "%": operator.mod,
+    "==": operator.eq, "!=": operator.ne, "<": operator.lt,
+    "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+    "&": lambda a, b: a and b, "|": lambda a, b: a or b
+}
+
+if numpy != None:
+    numpyOperators = {
+        "+": numpy.add, "-": numpy.subtract, "*": numpy.multiply,
+        "/": numpy.true_divide, "^": numpy.power, "%": numpy.mod,
+        "==": numpy.equal, "!=": numpy.not_equal, "<": numpy.less,
+        "<=": numpy.less_equal, ">": numpy.greater, ">=": numpy.greater_equal,
+        "&": lambda a, b: numpy.where(a != 0, b, a),
+        "|": lambda a, b: numpy.where(a != 0, a, b)
+    }
+    numpyFunctions = {
+        "COS": numpy.cos, "SIN": numpy.sin, "TAN": numpy.tan,
+        "ACOS": numpy.arccos, "ASIN": numpy.arcsin, "ATAN": numpy.arctan,
+        "COSH": numpy.cosh, "SINH": numpy.sinh, "TANH": numpy.tanh,
+        "ACOSH": numpy.arccosh, "ASINH": numpy.arcsinh, "ATANH": numpy.arctanh,
+        "DEG": numpy.degrees, "RAD": numpy.radians, "ABS": numpy.fabs,
+        "SQRT": numpy.sqrt, "LOG": numpy.log, "LOG2": numpy.log2,
+        "LOG10": numpy.log10, "EXP": numpy.exp,
+        # round half to even like round()
+        "ROUND": numpy.round, "CEIL": numpy.ceil, "FLOOR": numpy.floor
+    }
+
+def isVector(value):
+    if numpy == None:
+        return value.__class__ is array
+    return value.__class__ is numpy.ndarray
+
+def matVector(elements):
+    # the elements of a number array as a vector
+    return elements if numpy == None else numpy.frombuffer(elements)
+
+def matArray(value):
+    # a vector as the elements of a number array
+    if numpy == None:
+        return value
+    return array('d', value.astype(numpy.float64).tobytes())
+
+def matCopy(value):
+    if not(isVector(value)):
+        return value
+    return array('d', value) if numpy == None else value.copy()
+
+def matSum(value):
+    if not(isVector(value)):
+        raise BasicError("SUM needs an array.")
+    return math.fsum(value) if numpy == None else float(value.sum())
+
+def matApply(op, value):
+    # ! or a math function on every element
+    if not(isVector(value)):
+        return (not value) if op == "!" else math_functions[op](value)
+    if numpy != None:
+        return (value == 0) if op == "!" else numpyFunctions[op](value)
+    function = operator.not_ if op == "!" else math_functions[op]
+    return array('d', map(function, value))
+
+def matCombine(op, left, right):
+    leftVector = isVector(left)
+    rightVector = isVector(right)
+    if not(leftVector or rightVector):
+        return matOperators[op](left, right)
+    if leftVector and rightVector and len(left) != len(right):
+        raise BasicError("MAT arrays differ in size.")
+    if numpy != None:
+        return numpyOperators[op](left, right)
+    function = matOperators[op]
+    if not(leftVector):
+        left = repeat(left)
+    elif not(rightVector):
+        right = repeat(right)
+    return array('d', map(function, left, right))
+
+# LOAD only finds where each line of the text starts and leaves lexing,
+# parsing and compiling a line to the first time it is run or listed. The
+# line numbers and where they start are kept in name.tbc, with the
+# modification time, size and hash of the text, so the next LOAD of an
+# unchanged file doesn't even look at the lines. The statements parsed by a
+# run are added to name.tbc after it, a line found there is only compiled.
+
+lineHead = re.compile(r'([^ "()]+) *([^ "()]*)') # the line number and the first word
+
+def lineNumberOf(word):
+    if word.isdigit() and word.isascii():
+        return int(word)
+    return tokenLineNumber(lexWord(word))
+
+def tokenLineNumber(token):
+    # the line number of the first token of a line, None when it isn't one
+    if token[1] != "NUM" or not(math.isfinite(token[0])):
+        return None
+    return int(token[0])
+
+def scanProgram(text):
+    # gives the line numbers of the text mapped to the offset of each line and
+    # the set of lines RUN skips, raises a LoadError naming every bad line
+    lines = {}
+    silent = set()
+    badLines = []
+    start = 0
+    count = 0
+    size = len(text)
+    while start <= size:
+        end = text.find("\n", start)
+        if end == -1:
+            end = size
+        count += 1
+        line = text[start:end].strip()
+        if len(line) != 0:
+            match = lineHead.match(line)
+            lineNumber = None if match == None else lineNumberOf(match[1])
+            if lineNumber == None:
+                badLines.append(count)
+            # a line number alone deletes the line, and so does one with only
+            # a string that is never closed, which lex() drops
+            elif len(match[1]) == len(line) or (match[2] == "" and len(lex(line)) == 1):
+                lines.pop(lineNumber, None)
+                silent.discard(lineNumber)
+            else:
+                lines[lineNumber] = start
+                if match[2].upper() in silentWords:
+                    silent.add(lineNumber)
+                else:
+                    silent.discard(lineNumber)
+        start = end + 1
+    if len(badLines) != 0:
+        raise LoadError(badLines)
+    return lines, silent
+
+def cacheName(filename):
+    return os.path.splitext(filename)[0] + ".tbc"
+
+def readCache(filename):
+    # gives (key, mtime, size, hash, line numbers, offsets, skipped lines,
+    # parsed statements), or None when there is no cache this interpreter
+    # can use
+    try:
+        with open(cacheName(filename), 'rb') as f:
+            cache = marshal.loads(f.read()) # much faster than marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not(isinstance(cache, tuple)) or len(cache) != 8 or cache[0] != cacheKey or not(isinstance(cache[7], dict)):
+        return None
+    return cache
+
+def newCache(status, digest, lines, silent):
+    # the cache of a text just scanned, no line parsed yet
+    lineNumbers = sorted(lines)
+    return (cacheKey, status.st_mtime_ns, status.st_size, digest,
+        lineNumbers, [lines[i] for i in lineNumbers], sorted(silent), {})
+
+def writeCache(filename, cache):
+    # a cache that can't be written is only slower next time
+    temporary = cacheName(filename) + f".{os.getpid()}"
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(marshal.dumps(cache))
+        os.replace(temporary, cacheName(filename))
+    except (OSError, ValueError):
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+
+# A trace is a JSON list per line: first ["TRACE", VERSION, digest of the
+# program], then ["L", line] for every line run, ["W", name, value] for
+# every variable LET, INPUT or LDA, LDS, LDT writes, ["G", line, target]
+# and ["R", line] for GOSUB and RETURN, ["I", text] for every line INPUT
+# reads and ["E", message] for the error that stopped the run.
+
+class TraceWriter:
+    # the interpreter hands its records over a batch at a time and a thread
+    # of its own turns them into text and writes them
+    batchSize = 4096
+
+    def __init__(self, filename, digest):
+        self.file = open(filename, 'w')
+        self.batch = [("TRACE", VERSION, digest)]
+        self.batches = queue.Queue(64) # the run waits when the writer is that far behind
+        self.failed = False
+        self.error = None # why the writer failed, until the run is told
+        self.thread = threading.Thread(target = self.writeBatches, daemon = True)
+        self.thread.start()
+
+    def record(self, event):
+        self.batch.append(event)
+        if len(self.batch) == self.batchSize:
+            self.batches.put(self.batch)
+            self.batch = []
+            self.check()
+
+    def writeBatches(self):
+        while True:
+            batch = self.batches.get()
+            if batch == None:
+                break
+            # after a failed write the batches are only taken off the queue,
+            # so that the run doesn't wait for the writer forever
+            if self.failed:
+                continue
+            try:
+                # complex numbers are written as text
+                self.file.write("".join([json.dumps(event, default = str) + "\n" for event in batch]))
+            except Exception as e:
+                self.error = e
+                self.failed = True
+
+    def check(self):
+        # stops the run with the error of the writer, only once
+        error = self.error
+        if error != None:
+            self.error = None
+            reason = error.strerror if isinstance(error, OSError) else error
+            raise BasicError(f"Cannot write trace {self.file.name}: {reason}.")
+
+    def close(self):
+        self.batches.put(self.batch)
+        self.batches.put(None)
+        self.thread.join()
+        try:
+            self.file.close()
+        except OSError as e:
+            if not(self.failed):
+                self.error = e
+                self.failed = True
+        self.check()
+
+def readTrace(filename):
+    # gives the program digest and the INPUT lines of a trace
+    inputs = []
+    with open(filename, 'r') as f:
+        header = json.loads(f.readline())
+        if not(isinstance(header, list)) or len(header) != 3 or header[0] != "TRACE":
+            raise ValueError("not a trace")
+        for line in f:
+            if line.startswith('["I"'):
+                inputs.append(json.loads(line)[1])
+    return header[2], inputs
+
+# RUN FAST compiles the whole program into one flat list of (opcode, arg)
+# instructions, with the targets of GOTO, GOSUB, IF and FOR resolved to
+# positions in that list, and runs it in a single loop. Expressions stay the
+# closures built by compileExpression (a stack instruction per operator was
+# about twice as slow), FOR ... DO keeps its counter, end value and step on
+# the stack, FOR ... NEXT loops share forLoops with RUN.
+
+class Machine:
+    # a compiled program: the instructions, where each line starts (one
+    # extra entry for the end), where to go back to after a GOSUB
+    # and whether it counts statements for the limits of the run
+    __slots__ = ("code", "lineStarts", "returnTo", "limited")
+
+    def __init__(self, code, lineStarts, returnTo, limited):
+        self.code = code
+        self.lineStarts = lineStarts
+        self.returnTo = returnTo
+        self.limited = limited
+
+def changesProgram(statement):
+    # lines that edit the program while it runs need the line by line RUN
+    if statement == None:
+        return False
+    elif statement[0] in ["LINE", "LOAD", "CLEAR", "RUN"]:
+        return True
+    elif statement[0] == "IF":
+        return changesProgram(statement[2]) or changesProgram(statement[3])
+    elif statement[0] == "FOR":
+        return changesProgram(statement[5])
+    return False
+
+def staysInLine(statement):
+    # FOR bodies that never jump or stop can loop inside the machine
+    if statement[0] in ["GOTO", "GOSUB", "RETURN", "END", "EXIT", "ERROR", "NEXT"]:
+        return False
+    elif statement[0] == "IF":
+        return staysInLine(statement[2]) and (statement[3] == None or staysInLine(statement[3]))
+    elif statement[0] == "FOR":
+        return statement[5] != None and staysInLine(statement[5])
+    return True
+
+
+class Interpreter:
+    # everything one program needs: its lines, variables, call stack, limits
+    # and output. PRINT goes to output (any object with write(), stdout when
+    # None) and INPUT reads from input (a function giving the next line and
+    # raising EOFError when there is none, input() when None), so several
+    # interpreters can run side by side and be reused with reset()
+
+    def __init__(self, output = None, input = None):
+        self.output = output
+        self.input = input
+        self.lines = {}
+        self.lineNumbers = [] # sorted line numbers, for LIST and SAVE
+        # sorted numbers of the lines RUN executes (REM lines are left out) and the
+        # slot of each one, so RUN, GOTO and GOSUB never step through unused lines
+        self.runNumbers = []
+        self.programText = "" # the text of the last LOAD, see getLine()
+        # the statements of the lines of the loaded text parsed so far, and the
+        # file and cache they are saved to, see saveStatements()
+        self.statements = {}
+        self.cacheFile = None
+        self.statementsAdded = False
+        self.lineTexts = {} # what LIST shows for each line, see listLine()
+        self.pageSize = 0 # lines LIST shows before it waits, 0 to show them all
+        self.linePointer = 0
+        self.slotPointer = 0 # slot of the next line to execute
+        # the program compiled by RUN FAST and the threaded targets of GOTO and
+        # GOSUB, both dropped on any edit
+        self.machine = None
+        self.jumpTargets = {}
+        # MEMO: the registers each marked subroutine left at its RETURN, by the
+        # registers it was called with, kept for the memoSize calls used last,
+        # with [hits, misses] of the last run, dropped on any edit, and the
+        # calls waiting for their RETURN as (GOSUB depth, line, registers)
+        self.memos = {}
+        self.memoStats = {}
+        self.memoSize = 4096
+        self.memoCalls = []
+        self.stopExecution = False
+        # every variable name gets a slot the first time a line using it is
+        # compiled, a scope maps the slots of the variables set in it to their values
+        self.variableNames = []
+        self.variableSlots = {}
+        self.variableTypes = []
+        # the call stack: identifiers holds a scope for every GOSUB level, the
+        # current one last, a scope maps the slots set in it to their values so
+        # a GOSUB or RETURN costs the same however many names there are
+        self.identifiers = [{}]
+        self.frame = self.identifiers[0] # the current scope
+        self.returnPos = []
+        self.registers = {
+            "A": 0,
+            "S": 0,
+            "T": 0,
+        }
+        self.maxDepth = 10000 # deepest GOSUB nesting before a stack overflow, 0 for none
+        # limits of a run, 0 for none: statements run, seconds and characters held
+        # by all string variables, while limitsOn they are checked every ticksLeft
+        # statements
+        self.maxStatements = 0
+        self.maxTime = 0
+        self.maxStringSize = 0
+        self.limitsOn = False
+        self.ticksLeft = 0
+        self.ticksGiven = 0
+        self.statementsRun = 0
+        self.deadline = 0
+        # FOR loops without DO that wait for their NEXT, each one a list of
+        # [slot, counter, end, step, saved value, line of the FOR, GOSUB depth]
+        self.forLoops = []
+        self.printReady = True
+        self.lastError = None # the last error that stopped a command
+        # what the last RUN PROFILE measured: [count, total, self] seconds of each
+        # line and [calls, time] of each line a GOSUB went to
+        self.lineProfile = {}
+        self.gosubProfile = {}
+        # text waiting to be written to output, written out once bufferSize
+        # characters are waiting, before INPUT, on END, EXIT and FLUSH and when a
+        # command is done (a bufferSize of 0 writes everything at once)
+        self.outputBuffer = []
+        self.outputSize = 0
+        self.bufferSize = 65536
+        self.useCache = True # LOAD reads and writes .tbc files
+        self.tracer = None # the TraceWriter of a traced run
+
+    def load(self, source):
+        # replace the program with the lines of source, a string or an open
+        # file, only once every line has a line number
+        if not(isinstance(source, str)):
+            source = source.read()
+        self.setProgram(source, *scanProgram(source))
+
+    def loadFile(self, filename):
+        # LOAD a file, its lines and the statements parsed so far come from its
+        # .tbc file when that was written for the same text by this VERSION,
+        # else the .tbc is written
+        self.saveStatements()
+        status = os.stat(filename)
+        cache = readCache(filename) if self.useCache else None
+        with open(filename, 'r') as f:
+            text = f.read()
+        if cache != None and cache[1] == status.st_mtime_ns and cache[2] == status.st_size:
+            lines, silent = dict(zip(cache[4], cache[5])), set(cache[6])
+        else:
+            digest = hashlib.sha256(text.encode()).hexdigest()
+            if cache != None and cache[3] == digest: # touched but not changed
+                cache = (cacheKey, status.st_mtime_ns, status.st_size) + cache[3:]
+                lines, silent = dict(zip(cache[4], cache[5])), set(cache[6])
+            else:
+                lines, silent = scanProgram(text)
+                cache = newCache(status, digest, lines, silent)
+            if self.useCache:
+                writeCache(filename, cache)
+        self.setProgram(text, lines, silent)
+        if self.useCache:
+            self.statements = cache[7]
+            self.cacheFile = (filename, cache)
+
+    def saveStatements(self):
+        # the lines of a LOADed file parsed since go to its .tbc, the next LOAD
+        # of the same text takes them from there instead of parsing them again
+        if self.statementsAdded:
+            self.statementsAdded = False
+            writeCache(*self.cacheFile)
+
+    def setProgram(self, text, lines, silent):
+        # swap in a loaded program, lines holds the offset in text of each line
+        # until it is parsed
+        self.clearLines()
+        self.programText = text
+        self.lines = lines
+        self.lineNumbers = sorted(lines)
+        if len(silent) == 0:
+            self.runNumbers = self.lineNumbers.copy()
+        else:
+            self.runNumbers = [i for i in self.lineNumbers if i not in silent]
+
+    def getLine(self, lineNumber):
+        # the Line of a line number, a loaded line is parsed and compiled the
+        # first time it is needed
+        line = self.lines[lineNumber]
+        if line.__class__ is int:
+            statement = self.statements.get(lineNumber)
+            if statement == None:
+                statement = self.optimizeStatement(parseLine(self.sourceTokens(line)))
+                if self.cacheFile != None:
+                    self.statements[lineNumber] = statement
+                    self.statementsAdded = True
+            # the tokens of a loaded line are lexed again for LIST and SAVE
+            line = self.lines[lineNumber] = Line(line, statement, self.compileLine(statement))
+        return line
+
+    def lineTokens(self, lineNumber):
+        # the tokens of a line, without parsing a loaded line
+        line = self.lines[lineNumber]
+        if line.__class__ is int:
+            return self.sourceTokens(line)
+        if line.tokens.__class__ is int:
+            return self.sourceTokens(line.tokens)
+        return line.tokens
+
+    def sourceTokens(self, start):
+        # the tokens of the loaded line at start, without its line number
+        end = self.programText.find("\n", start)
+        if end == -1:
+            end = len(self.programText)
+        return lex(self.programText[start:end].strip())[1:]
+
+    def loadTokens(self, lines):
+        # replace the program with lines that are already split into tokens,
+        # the lines of a text with the empty ones left in
+        badLines = [count + 1 for count, tokens in enumerate(lines)
+            if len(tokens) != 0 and tokenLineNumber(tokens[0]) == None]
+        if len(badLines) != 0:
+            raise LoadError(badLines)
+        self.clearLines()
+        for tokens in lines:
+            if len(tokens) == 0:
+                continue
+            lineNumber = tokenLineNumber(tokens[0])
+            if len(tokens) != 1:
+                self.storeLine(lineNumber, tokens[1:])
+            else:
+                self.deleteLine(lineNumber)
+
+    def run(self, inputs = None, fast = False, profiled = False, trace = None):
+        # RUN the program, INPUT takes its lines from inputs when it is given,
+        # gives the error that stopped the run or None, trace names a file to
+        # log the run to
+        self.lastError = None
+        if trace != None:
+            try:
+                self.tracer = TraceWriter(trace, self.programDigest())
+            except OSError as e:
+                self.lastError = BasicError(f"Cannot write trace {trace}: {e.strerror}.")
+                self.writeOutput(f"Error: {self.lastError}\n")
+                self.flushOutput()
+                return self.lastError
+            self.recompileLines()
+        source = self.input
+        if inputs != None:
+            inputs = iter(inputs)
+            def nextInput():
+                for value in inputs:
+                    return str(value)
+                raise EOFError
+            self.input = nextInput
+        try:
+            self.runProgram(fast, profiled)
+        except EOFError:
+            self.lastError = BasicError("No more input.")
+            self.writeOutput(f"Error: {self.lastError}\n")
+            self.resetExcution()
+        except SystemExit: # EXIT ends the program like END
+            self.resetExcution()
+        finally:
+            self.stopExecution = False
+            self.limitsOn = False
+            self.input = source
+            if self.tracer != None:
+                tracer = self.tracer
+                self.tracer = None
+                self.recompileLines()
+                try:
+                    tracer.close()
+                except BasicError as e:
+                    self.writeOutput(f"Error: {e}\n")
+                    if self.lastError == None:
+                        self.lastError = e
+            self.flushOutput()
+        return self.lastError
+
+    def execute(self, line):
+        # run one line typed at the prompt, a numbered line edits the program
+        tokens = lex(line)
+        if len(tokens) != 0:
+            self.executeTokens(tokens)
+            self.stopExecution = False
+
+    def reset(self):
+        # forget the program, the variables and the last error and profile, the
+        # limits and sinks stay as they are
+        self.flushOutput()
+        self.clearLines()
+        self.variableNames = []
+        self.variableSlots = {}
+        self.variableTypes = []
+        self.resetExcution()
+        self.linePointer = 0
+        self.stopExecution = False
+        self.printReady = True
+        self.lastError = None
+        self.lineProfile = {}
+        self.gosubProfile = {}
+
+    def readInput(self):
+        # the next line for INPUT
+        value = input() if self.input == None else self.input()
+        if self.tracer != None:
+            self.tracer.record(("I", value))
+        return value
+
+    def programDigest(self):
+        # tells a trace which program it was written for
+        text = "".join([self.listLine(i) + "\n" for i in self.lineNumbers])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def recompileLines(self):
+        # compile the parsed lines again once tracing starts or stops
+        for line in self.lines.values():
+            if line.__class__ is not int:
+                line.code = self.compileLine(line.statement)
+        self.machine = None
+
+    def clearLines(self): # clear all codes
+        self.saveStatements()
+        self.lines = {}
+        self.lineTexts = {}
+        self.lineNumbers = []
+        self.runNumbers = []
+        self.programText = ""
+        self.statements = {}
+        self.cacheFile = None
+        self.slotPointer = 0
+        self.machine = None
+        self.jumpTargets.clear()
+        self.memos.clear()
+
+    def isRunLine(self, lineNumber):
+        slot = bisect.bisect_left(self.runNumbers, lineNumber)
+        return slot < len(self.runNumbers) and self.runNumbers[slot] == lineNumber
+
+    def addRunLine(self, lineNumber):
+        slot = bisect.bisect_left(self.runNumbers, lineNumber)
+        self.runNumbers.insert(slot, lineNumber)
+        # keep a running program on the line it was going to execute
+        if slot < self.slotPointer:
+            self.slotPointer += 1
+
+    def removeRunLine(self, lineNumber):
+        slot = bisect.bisect_left(self.runNumbers, lineNumber)
+        del self.runNumbers[slot]
+        if slot < self.slotPointer:
+            self.slotPointer -= 1
+
+    def storeLine(self, lineNumber, tokens): # add or replace a line
+        statement = self.optimizeStatement(parseLine(tokens))
+        line = Line(tokens, statement, self.compileLine(statement))
+        if lineNumber not in self.lines:
+            bisect.insort(self.lineNumbers, lineNumber)
+        self.lines[lineNumber] = line
+        self.lineTexts.pop(lineNumber, None)
+        # REM lines are listed and saved, but RUN never visits them
+        isRunLine = self.isRunLine(lineNumber)
+        if line.statement[0] != "REM" and not(isRunLine):
+            self.addRunLine(lineNumber)
+        elif line.statement[0] == "REM" and isRunLine:
+            self.removeRunLine(lineNumber)
+        self.machine = None
+        self.jumpTargets.clear()
+        self.memos.clear()
+
+    def deleteLine(self, lineNumber):
+        if self.lines.pop(lineNumber, None) is None:
+            return
+        self.lineTexts.pop(lineNumber, None)
+        del self.lineNumbers[bisect.bisect_left(self.lineNumbers, lineNumber)]
+        if self.isRunLine(lineNumber):
+            self.removeRunLine(lineNumber)
+        self.machine = None
+        self.jumpTargets.clear()
+        self.memos.clear()
+
+    def findLineSlot(self, lineNumber):
+        # slot of the line, or of the first line after it if it doesn't exist
+        return bisect.bisect_left(self.runNumbers, lineNumber)
+
+    def jumpSlot(self, lineNumber):
+        # slot a GOTO or GOSUB lands on: lines that only GOTO a constant line
+        # are followed straight through to the end of the chain
+        slot = self.jumpTargets.get(lineNumber)
+        if slot == None:
+            slot = self.findLineSlot(lineNumber)
+            visited = set()
+            while slot < len(self.runNumbers) and slot not in visited:
+                statement = self.getLine(self.runNumbers[slot]).statement
+                if statement[0] != "GOTO" or statement[1][0] != "NUM":
+                    break
+                visited.add(slot)
+                slot = self.findLineSlot(statement[1][1])
+            self.jumpTargets[lineNumber] = slot
+        return slot
+
+    def variableSlot(self, name):
+        slot = self.variableSlots.get(name)
+        if slot == None:
+            slot = len(self.variableNames)
+            self.variableSlots[name] = slot
+            self.variableNames.append(name)
+            self.variableTypes.append(getVarType(name))
+        return slot
+
+    def pushFrame(self, lineNumber):
+        # enter a subroutine called from lineNumber with a fresh scope
+        depth = len(self.returnPos) + 1
+        if depth > self.maxDepth and self.maxDepth != 0:
+            raise LimitError("depth", lineNumber)
+        self.returnPos.append(lineNumber)
+        self.frame = {}
+        self.identifiers.append(self.frame)
+
+    def popFrame(self):
+        # leave the subroutine, gives the line number it was called from
+        if len(self.returnPos) == 0:
+            raise BasicError("Not in a subroutine.")
+        if len(self.memoCalls) != 0:
+            self.memoReturn()
+        lineNumber = self.returnPos.pop()
+        self.identifiers.pop()
+        self.frame = self.identifiers[-1]
+        # loops left open inside the subroutine are gone with its scope
+        while len(self.forLoops) != 0 and self.forLoops[-1][6] > len(self.returnPos):
+            self.forLoops.pop()
+        return lineNumber
+
+    def memoCall(self, lineNumber):
+        # before a GOSUB to lineNumber, True when it is marked by MEMO and was
+        # already called with the same registers: the registers are then set
+        # to what its RETURN left and the call is skipped
+        cache = self.memos.get(lineNumber)
+        if cache == None:
+            return False
+        registers = self.registers
+        key = (registers["A"], registers["S"], registers["T"])
+        saved = cache.get(key)
+        stats = self.memoStats[lineNumber]
+        if saved == None:
+            stats[1] += 1
+            self.memoCalls.append((len(self.returnPos) + 1, lineNumber, key))
+            return False
+        stats[0] += 1
+        cache.move_to_end(key)
+        registers["A"], registers["S"], registers["T"] = saved
+        return True
+
+    def memoReturn(self):
+        # on RETURN, keep the registers of a call memoCall() let through
+        depth = len(self.returnPos)
+        while len(self.memoCalls) != 0 and self.memoCalls[-1][0] > depth: # left by GOTO
+            self.memoCalls.pop()
+        if len(self.memoCalls) == 0 or self.memoCalls[-1][0] != depth:
             return
-        varName = solveExpression(tokens[0:i], 0)
-        if varName == None:
-            stopExecution = True
+        lineNumber, key = self.memoCalls.pop()[1:]
+        cache = self.memos.get(lineNumber)
+        if cache == None:
             return
-        varName = varName[0]
-        if not(isValidIdentifier(varName)):
-            print(f"Error: {varName} is not a valid identifier.")
+        registers = self.registers
+        cache[key] = (registers["A"], registers["S"], registers["T"])
+        if len(cache) > self.memoSize:
+            cache.popitem(last = False)
+
+    def memoHandler(self, lineNumber):
+        # MEMO line: the subroutine a GOSUB to line lands on only reads the
+        # registers and only leaves its results in them
+        slot = self.jumpSlot(lineNumber)
+        if slot == len(self.runNumbers):
+            raise BasicError(f"No line {getNumberPrintFormat(lineNumber)} to MEMO.")
+        lineNumber = self.runNumbers[slot]
+        if lineNumber not in self.memos:
+            self.memos[lineNumber] = OrderedDict()
+            self.memoStats[lineNumber] = [0, 0]
+
+    def showMemos(self):
+        for lineNumber in sorted(self.memos):
+            hits, misses = self.memoStats[lineNumber]
+            self.writeOutput(f"MEMO {lineNumber}: {hits} hits, {misses} misses, {len(self.memos[lineNumber])} kept\n")
+
+    def resetExcution(self): # reset all variables and registers
+        self.identifiers = [{}]
+        self.frame = self.identifiers[0]
+        self.returnPos = []
+        self.forLoops = []
+        self.memoCalls = []
+        self.registers = {
+            "A": 0,
+            "S": 0,
+            "T": 0,
+        }
+
+    def executeTokens(self, tokens):
+        self.printReady = True
+        if tokens[0][1] == "NUM":
+            lineNumber = tokenLineNumber(tokens.pop(0))
+            if lineNumber == None:
+                self.writeOutput("Error: Invalid line number.\n")
+                self.flushOutput()
+                return
+            if len(tokens) != 0:
+                self.storeLine(lineNumber, tokens)
+            else:
+                self.deleteLine(lineNumber)
             return
-    if len(tokens[i+1:]) == 0:
-        print("Error: Expected expression.")
-        return
-    varValue = solveExpression(tokens[i+1:], 0)
-    if varValue == None:
-        return
-    if getVarType(varName) != varValue[1]:
-        print(f"Error: Variable {varName} type mismatch.")
-        return
-    identifiers[0][varName] = varValue
-    return True
+        code = self.compileLine(parseLine(tokens))
+        try:
+            try:
+                code()
+            except mathErrors as e:
+                raise mathError(e)
+        except BasicError as e:
+            self.writeOutput(f"Error: {e}\n")
+            self.lastError = e
+            self.stopExecution = True
+        finally:
+            self.flushOutput()
 
-def printHandler(tokens):
-    if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    exprRes = solveExpression(tokens, 0)
-    if exprRes == None:
-        return
-    # bug fixed: print out a number will cause it convert to int
-    value = exprRes[0]
-    if exprRes[1] == "NUM":
-        value = getNumberPrintFormat(value)
-    print(value)
-    return True
+    def runProgram(self, fast = False, profiled = False):
+        self.linePointer = 0
+        self.slotPointer = 0
+        # bug fixed: clear identifiers before execution
+        self.resetExcution()
+        for lineNumber in self.memos:
+            self.memos[lineNumber].clear()
+            self.memoStats[lineNumber] = [0, 0]
+        self.limitsOn = self.startLimits()
+        try:
+            # programs that edit themselves while running fall back to RUN
+            program = self.compileProgram(self.limitsOn) if fast and not(profiled) and self.tracer == None else None
+            if program != None:
+                self.runMachine(program)
+            elif self.tracer != None:
+                self.runTraced()
+            elif profiled:
+                self.lineProfile.clear()
+                self.gosubProfile.clear()
+                self.runProfiled()
+            else:
+                while self.slotPointer < len(self.runNumbers):
+                    self.linePointer = self.runNumbers[self.slotPointer]
+                    self.slotPointer += 1
+                    if self.limitsOn:
+                        self.tick()
+                    line = self.lines[self.linePointer]
+                    if line.__class__ is int:
+                        line = self.getLine(self.linePointer)
+                    line.code()
+                    if self.stopExecution:
+                        break
+        except mathErrors as e:
+            self.stopRun(mathError(e))
+        except BasicError as e:
+            self.stopRun(e)
+        self.stopExecution = False
+        self.limitsOn = False # no limits outside of a run
+        self.saveStatements()
+        # bug fixed: clear identifiers after execution
+        self.resetExcution()
 
-# store number to rigister A
-def staHandler(tokens):
-    global registers
-    if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    exprRes = solveExpression(tokens, 0)
-    if exprRes == None:
-        return
-    if exprRes[1] != "NUM":
-        print("Error: Rigister A expected number.")
-        return
-    registers["A"] = exprRes[0]
-    return True
+    def stopRun(self, e):
+        # report the error that stopped a run
+        self.writeOutput(f"Error: {e}\n")
+        self.lastError = e
+        if self.tracer != None:
+            self.tracer.record(("E", str(e)))
 
-def stsHandler(tokens):
-    global registers
-    if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    exprRes = solveExpression(tokens, 0)
-    if exprRes == None:
-        return
-    if exprRes[1] != "NUM":
-        print("Error: Rigister A expected number.")
-        return
-    registers["S"] = exprRes[0]
-    return True
+    def startLimits(self):
+        # set up the limits for a new run, True when there are any
+        self.statementsRun = 0
+        self.deadline = time.perf_counter() + self.maxTime
+        if self.maxStatements == 0 and self.maxTime == 0 and self.maxStringSize == 0:
+            return False
+        self.nextTicks()
+        return True
 
-def sttHandler(tokens):
-    global registers
-    if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    exprRes = solveExpression(tokens, 0)
-    if exprRes == None:
-        return
-    if exprRes[1] != "NUM":
-        print("Error: Rigister A expected number.")
-        return
-    registers["T"] = exprRes[0]
-    return True
+    def nextTicks(self):
+        # the statements to run before the limits are checked again
+        self.ticksGiven = 1024
+        if self.maxStatements != 0:
+            self.ticksGiven = max(min(self.ticksGiven, self.maxStatements - self.statementsRun + 1), 1)
+        self.ticksLeft = self.ticksGiven
 
-# load number from rigister A
-def ldaHandler(tokens):
-    global registers
-    varName = None
-    if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    elif len(tokens) == 1 and tokens[0][1] == "ID":
-        varName = tokens[0][0]
-    else:
-        varName = solveExpression(tokens, 0)[0]
-        if not(isValidIdentifier(varName)):
-            print(f"Error: {varName} is not a valid identifier.")
+    def tick(self):
+        # count a statement
+        self.ticksLeft -= 1
+        if self.ticksLeft == 0:
+            self.checkLimits()
+
+    def checkLimits(self):
+        # called when ticksLeft runs out, before the statement of linePointer
+        self.statementsRun += self.ticksGiven
+        if self.maxStatements != 0 and self.statementsRun > self.maxStatements:
+            raise LimitError("statements", self.linePointer)
+        if self.maxTime != 0 and time.perf_counter() > self.deadline:
+            raise LimitError("time", self.linePointer)
+        if self.maxStringSize != 0 and self.stringSize() > self.maxStringSize:
+            raise LimitError("string", self.linePointer)
+        self.nextTicks()
+
+    def stringSize(self):
+        # characters held by the string variables of every scope
+        size = 0
+        for scope in self.identifiers:
+            for value in scope.values():
+                if value.__class__ == str:
+                    size += len(value)
+                elif value.__class__ == Rope:
+                    size += value.size
+                elif value.__class__ == list: # a string array
+                    size += sum(map(len, value))
+        return size
+
+    def joinText(self, left, right):
+        # the . operator, one string can't be longer than all of them together
+        text = left + right
+        if self.maxStringSize != 0 and len(text) > self.maxStringSize:
+            raise LimitError("string", self.linePointer)
+        return text
+
+    def runTraced(self):
+        # the RUN loop logging every line and every GOSUB and RETURN, the lines
+        # log what they write themselves, see compileTraced()
+        record = self.tracer.record
+        depth = len(self.returnPos)
+        while self.slotPointer < len(self.runNumbers):
+            lineNumber = self.linePointer = self.runNumbers[self.slotPointer]
+            self.slotPointer += 1
+            if self.limitsOn:
+                self.tick()
+            record(("L", lineNumber))
+            line = self.lines[lineNumber]
+            if line.__class__ is int:
+                line = self.getLine(lineNumber)
+            line.code()
+            if depth != len(self.returnPos):
+                if depth < len(self.returnPos):
+                    target = self.runNumbers[self.slotPointer] if self.slotPointer < len(self.runNumbers) else None
+                    record(("G", lineNumber, target))
+                else:
+                    record(("R", self.linePointer))
+                depth = len(self.returnPos)
+            if self.stopExecution:
+                break
+
+    def runProfiled(self):
+        # the RUN loop with every line timed, a line that enters a GOSUB level
+        # also gets the time until it returns
+        timer = time.perf_counter
+        calls = [] # the calling line, the line called and the time of each level
+        # levels open for each calling and called line, a recursive call is
+        # already timed by the outermost one
+        callers = {}
+        called = {}
+        while self.slotPointer < len(self.runNumbers):
+            lineNumber = self.linePointer = self.runNumbers[self.slotPointer]
+            self.slotPointer += 1
+            if self.limitsOn:
+                self.tick()
+            start = timer()
+            line = self.lines[lineNumber]
+            if line.__class__ is int:
+                line = self.getLine(lineNumber)
+            line.code()
+            elapsed = timer() - start
+            stats = self.lineProfile.get(lineNumber)
+            if stats == None:
+                stats = self.lineProfile[lineNumber] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += elapsed
+            if len(calls) != len(self.returnPos):
+                now = timer()
+                while len(calls) > len(self.returnPos): # returned
+                    caller, target, start = calls.pop()
+                    callers[caller] -= 1
+                    if callers[caller] == 0:
+                        self.lineProfile[caller][1] += now - start
+                    called[target] -= 1
+                    if called[target] == 0:
+                        self.gosubProfile[target][1] += now - start
+                while len(calls) < len(self.returnPos): # called
+                    target = self.runNumbers[self.slotPointer] if self.slotPointer < len(self.runNumbers) else None
+                    calls.append((lineNumber, target, now))
+                    callers[lineNumber] = callers.get(lineNumber, 0) + 1
+                    called[target] = called.get(target, 0) + 1
+                    self.gosubProfile.setdefault(target, [0, 0.0])[0] += 1
+            if self.stopExecution:
+                break
+
+    def showProfile(self):
+        # the lines taking the most time first
+        if len(self.lineProfile) == 0:
+            raise BasicError("No profile, use RUN PROFILE first.")
+        self.writeOutput(f"{'LINE':>8}{'COUNT':>12}{'TOTAL':>12}{'SELF':>12}\n")
+        for lineNumber, stats in sorted(self.lineProfile.items(), key = lambda item: -item[1][2]):
+            self.writeOutput(f"{lineNumber:>8}{stats[0]:>12}{stats[1]:>12.6f}{stats[2]:>12.6f}\n")
+        if len(self.gosubProfile) != 0:
+            self.writeOutput(f"{'GOSUB':>8}{'CALLS':>12}{'TIME':>12}\n")
+            for lineNumber, stats in sorted(self.gosubProfile.items(), key = lambda item: -item[1][1]):
+                self.writeOutput(f"{lineNumber:>8}{stats[0]:>12}{stats[1]:>12.6f}\n")
+
+    def saveProfile(self, filename):
+        # JSON when the name ends in .json, else CSV with one row per line and
+        # per GOSUB target
+        if filename.lower().endswith(".json"):
+            profile = {
+                "lines": [{"line": lineNumber, "count": stats[0], "total": stats[1], "self": stats[2]}
+                    for lineNumber, stats in sorted(self.lineProfile.items())],
+                "gosub": [{"line": lineNumber, "calls": stats[0], "time": stats[1]}
+                    for lineNumber, stats in sorted(self.gosubProfile.items(), key = lambda item: str(item[0]))]
+            }
+            with open(filename, 'w') as f:
+                json.dump(profile, f, indent = 2)
             return
-    if getVarType(varName) != "NUM":
-        print(f"Error: Variable {varName} is not a number.")
-        return
-    executeTokens([["LET", "RESVD"], [varName, "ID"], ["=", "ASGN"], [registers["A"], "NUM"]])
-    return True
+        with open(filename, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(["kind", "line", "count", "total", "self"])
+            for lineNumber, stats in sorted(self.lineProfile.items()):
+                writer.writerow(["line", lineNumber, stats[0], stats[1], stats[2]])
+            for lineNumber, stats in sorted(self.gosubProfile.items(), key = lambda item: str(item[0])):
+                writer.writerow(["gosub", lineNumber, stats[0], stats[1], ""])
 
-def ldsHandler(tokens):
-    global registers
-    varName = None
-    if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    elif len(tokens) == 1 and tokens[0][1] == "ID":
-        varName = tokens[0][0]
-    else:
-        varName = solveExpression(tokens, 0)[0]
-        if not(isValidIdentifier(varName)):
-            print(f"Error: {varName} is not a valid identifier.")
+    def profileHandler(self, tokens):
+        # PROFILE shows the last profile, PROFILE "file" saves it
+        if len(tokens) == 0:
+            self.showProfile()
             return
-    if getVarType(varName) != "NUM":
-        print(f"Error: Variable {varName} is not a number.")
-        return
-    executeTokens([["LET", "RESVD"], [varName, "ID"], ["=", "ASGN"], [registers["S"], "NUM"]])
-    return True
+        if len(tokens) != 1 or tokens[0][1] != "STRING":
+            raise BasicError("Invalid filename.")
+        if len(self.lineProfile) == 0:
+            raise BasicError("No profile, use RUN PROFILE first.")
+        try:
+            self.saveProfile(tokens[0][0])
+        except OSError as e:
+            raise BasicError(f"Cannot write {tokens[0][0]}: {e.strerror}.")
 
-def ldtHandler(tokens):
-    global registers
-    varName = None
-    if len(tokens) == 0:
-        print("Error: Expected identifier.")
-        return
-    elif len(tokens) == 1 and tokens[0][1] == "ID":
-        varName = tokens[0][0]
-    else:
-        varName = solveExpression(tokens, 0)[0]
-        if not(isValidIdentifier(varName)):
-            print(f"Error: {varName} is not a valid identifier.")
+    def listLine(self, lineNumber):
+        # the text of a line for LIST and SAVE, kept until the line changes
+        text = self.lineTexts.get(lineNumber)
+        if text == None:
+            text = self.lineTexts[lineNumber] = lineText(lineNumber, self.lineTokens(lineNumber))
+        return text
+
+    def listHandler(self, first = None, last = None):
+        # the lines from first to last, a page at a time when pageSize is set
+        start = 0 if first == None else bisect.bisect_left(self.lineNumbers, first)
+        end = len(self.lineNumbers) if last == None else bisect.bisect_right(self.lineNumbers, last)
+        for slot in range(start, end):
+            self.writeOutput(self.listLine(self.lineNumbers[slot]) + "\n")
+            shown = slot - start + 1
+            if self.pageSize != 0 and shown % self.pageSize == 0 and slot + 1 < end:
+                if not(self.nextPage()):
+                    break
+
+    def nextPage(self):
+        # wait between two pages of a listing, False when the reader stops it
+        self.writeOutput("-- More (q to stop) --")
+        self.flushOutput()
+        try:
+            answer = self.readInput()
+        except EOFError:
+            return False
+        return answer.strip().lower() != "q"
+
+    def endHandler(self):
+        self.stopExecution = True
+        self.flushOutput()
+
+    def exitHandler(self):
+        self.flushOutput()
+        raise SystemExit
+
+    def clearHandler(self):
+        self.clearLines()
+        self.resetExcution()
+
+    def saveHandler(self, tokens):
+        self.printReady = True
+        if len(tokens) != 1:
+            self.writeOutput("Error: Invalid arguments.\n")
+            return False
+        if tokens[0][1] != "STRING":
+            self.writeOutput("Error: Invalid filename.\n")
+            return False
+        filename = tokens[0][0]
+        # if file extension not specified, add .tb
+        if '.' not in filename:
+            filename = filename + '.tb'
+        # if the file already exists, ask the user if he wants to overwrite it
+        if os.path.isfile(filename):
+            self.writeOutput(f"File {filename} already exists. Overwrite? (y/n)")
+            self.flushOutput()
+            overwrite = self.readInput()
+            if overwrite.lower() != "y":
+                return False
+        text = "".join([self.listLine(i) + "\n" for i in self.lineNumbers])
+        # written in one go to a file next to it that then takes its place, so
+        # the file is never left half written
+        temporary = f"{filename}.{os.getpid()}"
+        try:
+            with open(temporary, 'w') as f:
+                f.write(text)
+            os.replace(temporary, filename)
+        except OSError as e:
+            self.writeOutput(f"Error: Cannot write {filename}: {e.strerror}.\n")
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return False
+        return True
+
+    def loadHandler(self, tokens):
+        self.printReady = True
+        if len(tokens) != 1:
+            self.writeOutput("Error: Invalid arguments.\n")
+            return False
+        if tokens[0][1] != "STRING":
+            self.writeOutput("Error: Invalid filename.\n")
+            return False
+        filename = tokens[0][0]
+        # if file extension not specified, add .tb
+        if '.' not in filename:
+            filename = filename + '.tb'
+        try:
+            self.loadFile(filename)
+        except FileNotFoundError:
+            self.writeOutput("Error: File not found.\n")
+            return False
+        except OSError as e:
+            self.writeOutput(f"Error: Cannot read {filename}: {e.strerror}.\n")
+            return False
+        except UnicodeDecodeError:
+            self.writeOutput(f"Error: Cannot read {filename}: not a text file.\n")
+            return False
+        except BasicError as e:
+            self.writeOutput(f"Error: {e}\n")
+            return False
+        # a LOAD from a running program carries on after the current line number
+        self.slotPointer = bisect.bisect_right(self.runNumbers, self.linePointer)
+        return True
+
+    def gotoHandler(self, lineNumber):
+        self.slotPointer = self.jumpSlot(lineNumber)
+
+    def gosubHandler(self, lineNumber):
+        slot = self.jumpSlot(lineNumber)
+        if len(self.memos) != 0 and slot < len(self.runNumbers) and self.memoCall(self.runNumbers[slot]):
             return
-    if getVarType(varName) != "NUM":
-        print(f"Error: Variable {varName} is not a number.")
-        return
-    executeTokens([["LET", "RESVD"], [varName, "ID"], ["=", "ASGN"], [registers["T"], "NUM"]])
-    return True
+        self.pushFrame(self.linePointer) # push current line number to stack
+        self.slotPointer = slot # jump to subroutine
 
-def getIdentifierValue(name):
-    try:
-        return identifiers[0][name].copy()
-    except KeyError:
-        return None
+    def returnHandler(self):
+        self.linePointer = self.popFrame() # pop current line number from stack
+        self.slotPointer = bisect.bisect_right(self.runNumbers, self.linePointer)
 
-def solveExpression(tokens, level):
-    leftSideValues = []
-    rightSideValues = []
-    if level < len(operators):
-        i = 0
-        while i < len(tokens):
-            if not(tokens[i][1] in ["OP", "NUM", "STRING", "ID", 'PAREN']):
-                print(f"Error: Unknown operand {tokens[i][0]}")
-                return None
-            elif tokens[i][1] == "PAREN":
-                # find the matching close parentheses
-                close = findMatchingClose(tokens, i)
-                if close == None:
-                    print("Error: Unmatched parentheses.")
-                    return None
-                # solve the expression inside the parentheses
-                subExpr = solveExpression(tokens[i+1:close], 0)
-                if subExpr == None:
-                    return None
-                leftSideValues.append(subExpr)
-                # continue to the next token
-                i = close
-            elif tokens[i][1] == "OP" and tokens[i][0] in operators[level]:
-                exprResL = None
-                exprResR = None
-                if len(leftSideValues) != 0:
-                    exprResL = solveExpression(leftSideValues, level)
-                rightSideValues = tokens[i+1:]
-                if len(rightSideValues) != 0:
-                    exprResR = solveExpression(rightSideValues, level)
-                
-                if tokens[i][0] == "+":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [exprResL[0] + exprResR[0], "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
-                elif tokens[i][0] == "-":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [exprResL[0] - exprResR[0], "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
-                elif tokens[i][0] == "/":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [exprResL[0] / exprResR[0], "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None 
-                elif tokens[i][0] == "*":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [exprResL[0] * exprResR[0], "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None     
-                elif tokens[i][0] == "^":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [exprResL[0] ** exprResR[0], "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
-                elif tokens[i][0] == "%":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [exprResL[0] % exprResR[0], "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
-                elif tokens[i][0] == "==":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    else:
-                        return [exprResL[0] == exprResR[0], "NUM"]
-                elif tokens[i][0] == "!=":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    else:
-                        return [exprResL[0] != exprResR[0], "NUM"]
-                elif tokens[i][0] == "<=":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    else:
-                        return [exprResL[0] <= exprResR[0], "NUM"]
-                elif tokens[i][0] == "<":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    else:
-                        return [exprResL[0] < exprResR[0], "NUM"]
-                elif tokens[i][0] == ">":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    else:
-                        return [exprResL[0] > exprResR[0], "NUM"]
-                elif tokens[i][0] == ">=":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    else:
-                        return [exprResL[0] >= exprResR[0], "NUM"]
-                # operator <<
-                elif tokens[i][0] == "<<":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    if exprResL[1] != "NUM" or exprResR[1] != "NUM":
-                        print("Error: Operand type mismatch.")
-                        return None
-                    if int(exprResL[0]) != exprResL[0] or int(exprResR[0]) != exprResR[0]:
-                        print("Error: Operand type mismatch.")
-                        return None
-                    return [float(int(exprResL[0]) << int(exprResR[0])), "NUM"]
-                # operator >>
-                elif tokens[i][0] == ">>":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    if exprResL[1] != "NUM" or exprResR[1] != "NUM":
-                        print("Error: Operand type mismatch.")
-                        return None
-                    if int(exprResL[0]) != exprResL[0] or int(exprResR[0]) != exprResR[0]:
-                        print("Error: Operand type mismatch.")
-                        return None
-                    return [float(int(exprResL[0]) >> int(exprResR[0])), "NUM"]
-                elif tokens[i][0] == "&":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [(exprResL[0]) and (exprResR[0]), "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
-                elif tokens[i][0] == "|":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    elif exprResL[1] == "NUM" and exprResR[1] == "NUM":
-                        return [(exprResL[0]) or (exprResR[0]), "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
-                elif tokens[i][0] == ".":
-                    if exprResL == None or exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    else:
-                        value1 = exprResL[0]
-                        if exprResL[1] == "NUM":
-                            value1 = str(getNumberPrintFormat(value1))
-                        value2 = exprResR[0]
-                        if exprResR[1] == "NUM":
-                            value2 = str(getNumberPrintFormat(value2))
-                        return [value1 + value2, "STRING"]
-                # operator !
-                elif tokens[i][0] == "!":
-                    # as an unary operator, ! only takes one argument
-                    if exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    if exprResL != None:
-                        print("Error: ! is an unary operator.")
-                        return None
-                    if exprResR[1] == "NUM":
-                        return [not exprResR[0], "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
-                # math function also handle as a unary operator
-                elif tokens[i][0] in math_functions:
-                    if exprResR == None:
-                        print("Error: Operator expects value.")
-                        return None
-                    if exprResL != None:
-                        print("Error: Function is unary operator.")
-                        return None
-                    if exprResR[1] == "NUM":
-                        return [math_functions[tokens[i][0]](exprResR[0]), "NUM"]
-                    else:
-                        print("Error: Operand type mismatch.")
-                        return None
+    def inputHandler(self, slot):
+        self.frame[slot] = self.inputValue(self.variableTypes[slot])
+
+    def inputValue(self, valueType):
+        # ask until the answer is of the type wanted
+        while True:
+            self.writeOutput("?")
+            self.flushOutput()
+            varValue = self.readInput()
+            if valueType == "STRING":
+                return varValue
             else:
-                leftSideValues.append(tokens[i])
-            i += 1
-        return solveExpression(leftSideValues, level + 1)
-    else:
-        if len(tokens) > 1:
-            print("Error: Operator expected.")
+                if is_number(varValue):
+                    # bug fixed: varValue -> float(varValue)
+                    return toNumber(varValue)
+                else:
+                    self.writeOutput("Try again.\n")
+
+    def dimHandler(self, slot, size):
+        # DIM a(size) makes a(0) to a(size), numbers are kept in an array of
+        # doubles and start at 0, strings start empty
+        try:
+            if isinstance(size, complex) or size < 0 or int(size) != size:
+                raise BasicError("Invalid array size.")
+            length = int(size) + 1
+            if self.variableTypes[slot] == "STRING":
+                self.frame[slot] = [""] * length
+            else:
+                self.frame[slot] = array('d', bytes(8 * length))
+        except (ValueError, OverflowError, MemoryError):
+            raise BasicError("Invalid array size.")
+
+    def forHandler(self, slot, start, end, step, body):
+        # get a copy of iterator variable
+        iterVar = self.frame.get(slot, unset)
+        # set the iterator to the first value
+        counter = start()
+        self.frame[slot] = counter
+        # calculate the end value and the step, once
+        endValue = end()
+        stepValue = 1 if step == None else step()
+        # execute the FOR statement, every run of the body counts as a statement
+        if stepValue >= 0:
+            while counter <= endValue:
+                if self.limitsOn:
+                    self.tick()
+                body()
+                counter += stepValue
+                self.frame[slot] = counter
+        else:
+            while counter >= endValue:
+                if self.limitsOn:
+                    self.tick()
+                body()
+                counter += stepValue
+                self.frame[slot] = counter
+        # restore the iterator variable
+        if iterVar is not unset:
+            self.frame[slot] = iterVar
+
+    def forLoop(self, slot, start, end, step, lineNumber):
+        # FOR without DO: start a loop over the lines up to its NEXT, False
+        # when the body is not run at all
+        iterVar = self.frame.get(slot, unset)
+        depth = len(self.returnPos)
+        if len(self.forLoops) != 0 and self.forLoops[-1][0] == slot and self.forLoops[-1][6] == depth:
+            iterVar = self.forLoops.pop()[4] # the loop was left by a GOTO and entered again
+        counter = start()
+        self.frame[slot] = counter
+        endValue = end()
+        stepValue = 1 if step == None else step()
+        if counter <= endValue if stepValue >= 0 else counter >= endValue:
+            self.forLoops.append([slot, counter, endValue, stepValue, iterVar, lineNumber, depth])
+            return True
+        if iterVar is not unset:
+            self.frame[slot] = iterVar
+        return False
+
+    def nextLoop(self, slot):
+        # step the innermost loop (or the one of the given variable), gives the
+        # line of its FOR while it goes on and None once it is done
+        depth = len(self.returnPos)
+        while len(self.forLoops) != 0 and self.forLoops[-1][6] == depth:
+            loop = self.forLoops[-1]
+            if slot == None or loop[0] == slot:
+                break
+            self.forLoops.pop() # an inner loop left by a GOTO
+        else:
+            raise BasicError("NEXT without FOR.")
+        counter = loop[1] + loop[3]
+        loop[1] = counter
+        self.frame[loop[0]] = counter
+        if counter <= loop[2] if loop[3] >= 0 else counter >= loop[2]:
+            return loop[5]
+        self.forLoops.pop()
+        # restore the iterator variable
+        if loop[4] is not unset:
+            self.frame[loop[0]] = loop[4]
+        return None
+
+    def findNext(self, slot):
+        # the slot of the NEXT closing a FOR whose body starts at slot
+        nested = 0
+        while slot < len(self.runNumbers):
+            statement = self.getLine(self.runNumbers[slot]).statement
+            if statement[0] == "FOR" and statement[5] == None:
+                nested += 1
+            elif statement[0] == "NEXT":
+                if nested == 0:
+                    return slot
+                nested -= 1
+            slot += 1
+        raise BasicError("FOR without NEXT.")
+
+    def loopHandler(self, slot, start, end, step):
+        if not(self.forLoop(slot, start, end, step, self.linePointer)):
+            self.slotPointer = self.findNext(self.slotPointer) + 1
+
+    def nextHandler(self, slot):
+        lineNumber = self.nextLoop(slot)
+        if lineNumber != None:
+            self.slotPointer = bisect.bisect_right(self.runNumbers, lineNumber)
+
+    def printHandler(self, value, valueType):
+        # bug fixed: print out a number will cause it convert to int
+        if valueType == "NUM":
+            value = numberText(value)
+        self.writeOutput(f"{value}\n")
+
+    def writeOutput(self, text):
+        self.outputBuffer.append(text)
+        self.outputSize += len(text)
+        if self.outputSize >= self.bufferSize:
+            self.flushOutput()
+
+    def flushOutput(self):
+        output = sys.stdout if self.output == None else self.output
+        if len(self.outputBuffer) != 0:
+            output.write("".join(self.outputBuffer))
+            self.outputBuffer.clear()
+            self.outputSize = 0
+        if hasattr(output, "flush"):
+            output.flush()
+
+    # load number from rigister A, S or T
+    def loadRegister(self, slot, register):
+        self.frame[slot] = self.registers[register]
+
+    def dirHandler(self):
+        # set variables of the current scope by name, in the order they were
+        # first set in it
+        scope = {}
+        for slot, value in self.frame.items():
+            if value.__class__ == array or value.__class__ == list:
+                value = list(value)
+            elif value.__class__ == Rope:
+                value = value.flatten()
+            elif value.__class__ == int and abs(value) < 2 ** 53: # shown as it always was
+                value = float(value)
+            scope[self.variableNames[slot]] = [value, self.variableTypes[slot]]
+        self.writeOutput(f"{scope}\n")
+
+    def optimizeStatement(self, statement):
+        # fold the constant parts of every expression in a stored statement
+        command = statement[0]
+        if command in ["PRINT", "GOTO", "GOSUB"]:
+            return (command, self.foldExpression(statement[1]))
+        elif command == "MEMO" and statement[1] != None:
+            return ("MEMO", self.foldExpression(statement[1]))
+        elif command == "LET":
+            return ("LET", self.foldTarget(statement[1]), self.foldExpression(statement[2]))
+        elif command == "INPUT":
+            return ("INPUT", self.foldTarget(statement[1]))
+        elif command == "DIM" or command == "MAT":
+            return (command, statement[1], self.foldExpression(statement[2]))
+        elif command == "ST":
+            return ("ST", statement[1], self.foldExpression(statement[2]))
+        elif command == "LD":
+            return ("LD", statement[1], self.foldTarget(statement[2]))
+        elif command == "IF":
+            elseStatement = statement[3]
+            if elseStatement != None:
+                elseStatement = self.optimizeStatement(elseStatement)
+            return ("IF", self.foldExpression(statement[1]), self.optimizeStatement(statement[2]), elseStatement)
+        elif command == "FOR":
+            step = statement[4]
+            if step != None:
+                step = self.foldExpression(step)
+            body = statement[5]
+            if body != None:
+                body = self.optimizeStatement(body)
+            return ("FOR", statement[1], self.foldExpression(statement[2]),
+                self.foldExpression(statement[3]), step, body)
+        return statement
+
+    def foldTarget(self, target):
+        # a name built from constants is as good as a plain name
+        if isinstance(target, str):
+            return target
+        target = self.foldExpression(target)
+        if target[0] == "STRING" and isValidIdentifier(target[1]):
+            return target[1]
+        return target
+
+    def foldExpression(self, tree):
+        if tree[0] == "ELEM":
+            return ("ELEM", tree[1], self.foldExpression(tree[2]))
+        if tree[0] != "OP":
+            return tree
+        left = tree[2]
+        if left != None:
+            left = self.foldExpression(left)
+        right = self.foldExpression(tree[3])
+        tree = ("OP", tree[1], left, right)
+        if right[0] in ["NUM", "STRING"] and (left == None or left[0] in ["NUM", "STRING"]):
+            try:
+                value, valueType = self.compileExpression(tree)
+                return (valueType, value())
+            except Exception:
+                # errors like a division by zero are left to happen at run time
+                pass
+        return tree
+
+    def compileLine(self, statement):
+        try:
+            return self.compileStatement(statement)
+        except BasicError as e:
+            return failing(str(e))
+
+    def compileStatement(self, statement):
+        # turn a parsed statement into a closure that runs it, errors found
+        # here (like type mismatches) are raised when the closure is called
+        command = statement[0]
+        if self.tracer != None and command in ["LET", "INPUT", "LD"]:
+            return self.compileTraced(statement)
+        if command == "REM":
+            return lambda: None
+        elif command == "ERROR":
+            return failing(statement[1])
+        elif command == "LINE": # a line number after THEN, ELSE or DO
+            tokens = statement[1]
+            return lambda: self.executeTokens(tokens[:])
+        elif command == "CLS":
+            return lambda: self.writeOutput("\n"*501)
+        elif command == "END":
+            return self.endHandler
+        elif command == "EXIT":
+            return self.exitHandler
+        elif command == "FLUSH":
+            return self.flushOutput
+        elif command == "CLEAR":
+            return self.clearHandler
+        elif command == "DIR": # list all the variables and their values in the current scope
+            return self.dirHandler
+        elif command == "LIST":
+            first = statement[1]
+            last = statement[2]
+            return lambda: self.listHandler(first, last)
+        elif command == "RUN":
+            fast = statement[1]
+            profiled = statement[2]
+            def runCode():
+                self.runProgram(fast, profiled)
+                if profiled:
+                    self.showProfile()
+            return runCode
+        elif command == "PROFILE":
+            tokens = statement[1]
+            return lambda: self.profileHandler(tokens)
+        elif command == "PRINT":
+            value, valueType = self.compileExpression(statement[1])
+            return lambda: self.printHandler(value(), valueType)
+        elif command == "LET":
+            return self.compileLet(statement[1], statement[2])
+        elif command == "INPUT":
+            if not(isinstance(statement[1], str)) and statement[1][0] == "ELEM":
+                name = statement[1][1]
+                store = self.compileElementStore(name, statement[1][2])
+                return lambda: store(self.inputValue(getVarType(name)))
+            target = self.compileTarget(statement[1])
+            return lambda: self.inputHandler(target())
+        elif command == "DIM":
+            slot = self.arraySlot(statement[1])
+            size, sizeType = self.compileExpression(statement[2])
+            if sizeType != "NUM":
+                raise BasicError("Expected number.")
+            return lambda: self.dimHandler(slot, size())
+        elif command == "MAT":
+            return self.compileMatStatement(statement[1], statement[2])
+        elif command == "GOTO" or command == "GOSUB":
+            lineNumber, lineType = self.compileExpression(statement[1])
+            if lineType != "NUM":
+                return lambda: self.writeOutput("Error: Line number expected.\n")
+            if command == "GOTO":
+                return lambda: self.gotoHandler(lineNumber())
+            return lambda: self.gosubHandler(lineNumber())
+        elif command == "RETURN":
+            return self.returnHandler
+        elif command == "MEMO":
+            if statement[1] == None:
+                return self.showMemos
+            lineNumber, lineType = self.compileExpression(statement[1])
+            if lineType != "NUM":
+                raise BasicError("Line number expected.")
+            return lambda: self.memoHandler(lineNumber())
+        elif command == "IF":
+            condition = self.compileExpression(statement[1])[0]
+            thenCode = self.compileLine(statement[2])
+            elseCode = None
+            if statement[3] != None:
+                elseCode = self.compileLine(statement[3])
+            def ifCode():
+                if condition() != 0:
+                    thenCode()
+                elif elseCode != None:
+                    elseCode()
+            return ifCode
+        elif command == "FOR":
+            varName = statement[1]
+            start, startType = self.compileExpression(statement[2])
+            if getVarType(varName) != startType:
+                raise BasicError(f"Variable {varName} type mismatch.")
+            end, endType = self.compileExpression(statement[3])
+            if endType != "NUM":
+                raise BasicError("Expected number.")
+            step = self.compileStep(statement[4])
+            slot = self.variableSlot(varName)
+            if statement[5] == None:
+                return lambda: self.loopHandler(slot, start, end, step)
+            body = self.compileLine(statement[5])
+            return lambda: self.forHandler(slot, start, end, step, body)
+        elif command == "NEXT":
+            slot = None
+            if statement[1] != None:
+                slot = self.variableSlot(statement[1])
+            return lambda: self.nextHandler(slot)
+        elif command == "ST":
+            register = statement[1]
+            value, valueType = self.compileExpression(statement[2])
+            if valueType != "NUM":
+                raise BasicError("Rigister A expected number.")
+            def stCode():
+                self.registers[register] = value()
+            return stCode
+        elif command == "LD":
+            register = statement[1]
+            if isinstance(statement[2], str):
+                varName = statement[2]
+                if getVarType(varName) != "NUM":
+                    raise BasicError(f"Variable {varName} is not a number.")
+                slot = self.variableSlot(varName)
+                return lambda: self.loadRegister(slot, register)
+            target = self.compileTarget(statement[2])
+            def ldCode():
+                slot = target()
+                if self.variableTypes[slot] != "NUM":
+                    raise BasicError(f"Variable {self.variableNames[slot]} is not a number.")
+                self.loadRegister(slot, register)
+            return ldCode
+        elif command == "SAVE" or command == "LOAD":
+            handler = self.saveHandler if command == "SAVE" else self.loadHandler
+            tokens = statement[1]
+            def fileCode():
+                if not(handler(tokens)): self.stopExecution = True
+            return fileCode
+
+    def compileStep(self, step):
+        if step == None:
             return None
-        elif tokens[0][1] == "ID":
-            if tokens[0][0] in identifiers[0]:
-                return getIdentifierValue(tokens[0][0])
+        step, stepType = self.compileExpression(step)
+        if stepType != "NUM":
+            raise BasicError("Expected number.")
+        # a step of 0 would never get to the end value
+        def stepValue():
+            value = step()
+            if value == 0:
+                raise BasicError("Invalid STEP.")
+            return value
+        return stepValue
+
+    def compileTraced(self, statement):
+        # LET, INPUT or LD that also logs the variable it wrote
+        tracer = self.tracer
+        self.tracer = None # the statement itself as always
+        try:
+            code = self.compileStatement(statement)
+        finally:
+            self.tracer = tracer
+        target = statement[2] if statement[0] == "LD" else statement[1]
+        if not(isinstance(target, str)) and target[0] == "ELEM":
+            name = target[1]
+            slot, index = self.compileIndex(name, target[2])
+            def tracedCode():
+                code()
+                i = toIndex(index(), len(self.frame[slot]))
+                self.tracer.record(("W", f"{name}({i})", self.frame[slot][i]))
+            return tracedCode
+        target = self.compileTarget(target)
+        def tracedCode():
+            code()
+            slot = target()
+            value = self.frame[slot]
+            if value.__class__ is Rope:
+                value = value.flatten()
+            self.tracer.record(("W", self.variableNames[slot], value))
+        return tracedCode
+
+    def compileTarget(self, target):
+        # gives the slot of the variable being assigned
+        if isinstance(target, str):
+            slot = self.variableSlot(target)
+            return lambda: slot
+        varName = self.compileExpression(target)[0]
+        return lambda: self.variableSlot(checkIdentifier(varName()))
+
+    def compileLet(self, target, value):
+        if isinstance(target, str) and isAppend(target, value):
+            return self.compileAppend(target, value[3])
+        value, valueType = self.compileExpression(value)
+        if not(isinstance(target, str)) and target[0] == "ELEM":
+            if getVarType(target[1]) != valueType:
+                raise BasicError(f"Array {target[1]} type mismatch.")
+            store = self.compileElementStore(target[1], target[2])
+            return lambda: store(value())
+        if isinstance(target, str):
+            if getVarType(target) != valueType:
+                raise BasicError(f"Variable {target} type mismatch.")
+            slot = self.variableSlot(target)
+            def letCode():
+                self.frame[slot] = value()
+            return letCode
+        target = self.compileTarget(target)
+        def letCode():
+            slot = target()
+            varValue = value()
+            if self.variableTypes[slot] != valueType:
+                raise BasicError(f"Variable {self.variableNames[slot]} type mismatch.")
+            self.frame[slot] = varValue
+        return letCode
+
+    def compileAppend(self, name, tree):
+        # LET a$ = a$ . text adds text to a Rope in a$ instead of copying a$
+        slot = self.variableSlot(name)
+        text, textType = self.compileExpression(tree)
+        if textType == "NUM":
+            text = numberToText(text)
+        def appendCode():
+            value = self.frame.get(slot, unset)
+            if value is unset:
+                raise BasicError(f"Variable {name} not initialized.")
+            piece = text()
+            if value.__class__ is not Rope:
+                value = self.frame[slot] = Rope(value)
+            value.append(piece)
+            if self.maxStringSize != 0 and value.size > self.maxStringSize:
+                raise LimitError("string", self.linePointer)
+        return appendCode
+
+    def arraySlot(self, name):
+        # arrays are kept apart from the variables of the same name
+        slot = self.variableSlot(name + "()")
+        self.variableTypes[slot] = getVarType(name)
+        return slot
+
+    def compileIndex(self, name, index):
+        # gives the slot of the array and the closure of the index
+        index, indexType = self.compileExpression(index)
+        if indexType != "NUM":
+            raise BasicError("Index must be a whole number.")
+        return self.arraySlot(name), index
+
+    def compileElement(self, name, index):
+        slot, index = self.compileIndex(name, index)
+        def value():
+            try:
+                elements = self.frame[slot]
+            except KeyError:
+                raise BasicError(f"Array {name} not dimensioned.")
+            i = index()
+            if i.__class__ is not int or i < 0 or i >= len(elements):
+                i = toIndex(i, len(elements))
+            return elements[i]
+        return value
+
+    def compileElementStore(self, name, index):
+        # gives a function that stores its value in an element
+        slot, index = self.compileIndex(name, index)
+        def store(value):
+            try:
+                elements = self.frame[slot]
+            except KeyError:
+                raise BasicError(f"Array {name} not dimensioned.")
+            i = index()
+            if i.__class__ is not int or i < 0 or i >= len(elements):
+                i = toIndex(i, len(elements))
+            try:
+                elements[i] = value
+            except (TypeError, OverflowError): # complex numbers don't fit
+                raise BasicError(f"Array {name} type mismatch.")
+        return store
+
+    def compileMatStatement(self, name, tree):
+        # MAT name = expression stores an array result in the array name and
+        # a number, like the result of SUM, in the variable name
+        if getVarType(name) != "NUM":
+            raise BasicError("MAT only works on numbers.")
+        value = self.compileMat(tree)
+        if tree[0] == "ID": # a copy, not one array under two names
+            source = value
+            value = lambda: matCopy(source())
+        arraySlot = self.arraySlot(name)
+        slot = self.variableSlot(name)
+        def matCode():
+            if numpy == None:
+                result = value()
             else:
-                print(f"Error: Variable {tokens[0][0]} not initialized.")
+                with numpy.errstate(divide="raise", invalid="raise", over="ignore", under="ignore"):
+                    result = value()
+            if isVector(result):
+                self.frame[arraySlot] = matArray(result)
+            else:
+                self.frame[slot] = result
+        def matCheckedCode():
+            try:
+                matCode()
+            except (ArithmeticError, ValueError) as e:
+                raise BasicError(f"Math error in MAT: {e}.")
+            except TypeError: # complex numbers don't fit
+                raise BasicError(f"Array {name} type mismatch.")
+        return matCheckedCode
+
+    def compileMat(self, tree):
+        # like compileExpression() but a name is its array when that is
+        # dimensioned, else its variable, SUM(a) adds up an array and
+        # operators and functions work on every element
+        if tree[0] == "NUM":
+            value = tree[1]
+            return lambda: value
+        elif tree[0] == "STRING" or (tree[0] in ["ID", "ELEM"] and getVarType(tree[1]) != "NUM"):
+            raise BasicError("MAT only works on numbers.")
+        elif tree[0] == "ID":
+            name = tree[1]
+            arraySlot = self.arraySlot(name)
+            variable = self.compileIdentifier(name)
+            def value():
+                elements = self.frame.get(arraySlot, unset)
+                if elements is unset:
+                    return variable()
+                return matVector(elements)
+            return value
+        elif tree[0] == "ELEM":
+            if tree[1] == "SUM":
+                elements = self.compileMat(tree[2])
+                return lambda: matSum(elements())
+            return self.compileElement(tree[1], tree[2])
+        op = tree[1]
+        right = self.compileMat(tree[3])
+        if tree[2] == None:
+            return lambda: matApply(op, right())
+        if op not in matOperators:
+            raise BasicError(f"MAT can't use {op}.")
+        left = self.compileMat(tree[2])
+        return lambda: matCombine(op, left(), right())
+
+    def compileIdentifier(self, name):
+        slot = self.variableSlot(name)
+        if getVarType(name) == "STRING":
+            def text():
+                try:
+                    value = self.frame[slot]
+                except KeyError:
+                    raise BasicError(f"Variable {name} not initialized.")
+                if value.__class__ is Rope:
+                    return value.flatten()
+                return value
+            return text
+        def value():
+            try:
+                return self.frame[slot]
+            except KeyError:
+                raise BasicError(f"Variable {name} not initialized.")
+        return value
+
+    def compileExpression(self, tree):
+        # turn an expression tree into a closure, returns the closure and the
+        # type of the value it gives: variable types are fixed by their names so
+        # every type is known here and never has to be checked while running
+        if tree[0] == "NUM" or tree[0] == "STRING":
+            value = tree[1]
+            return (lambda: value), tree[0]
+        elif tree[0] == "ID":
+            return self.compileIdentifier(tree[1]), getVarType(tree[1])
+        elif tree[0] == "ELEM":
+            return self.compileElement(tree[1], tree[2]), getVarType(tree[1])
+        op = tree[1]
+        right, rightType = self.compileExpression(tree[3])
+        # ! and math functions only take the right side
+        if tree[2] == None:
+            if rightType != "NUM":
+                raise BasicError("Operand type mismatch.")
+            if op == "!":
+                return (lambda: not right()), "NUM"
+            function = math_functions[op]
+            return (lambda: function(right())), "NUM"
+        left, leftType = self.compileExpression(tree[2])
+        if op == "==":
+            return (lambda: left() == right()), "NUM"
+        elif op == "!=":
+            return (lambda: left() != right()), "NUM"
+        elif op == "<=":
+            return (lambda: left() <= right()), "NUM"
+        elif op == "<":
+            return (lambda: left() < right()), "NUM"
+        elif op == ">":
+            return (lambda: left() > right()), "NUM"
+        elif op == ">=":
+            return (lambda: left() >= right()), "NUM"
+        elif op == ".":
+            if leftType == "NUM":
+                left = numberToText(left)
+            if rightType == "NUM":
+                right = numberToText(right)
+            return (lambda: self.joinText(left(), right())), "STRING"
+        if leftType != "NUM" or rightType != "NUM":
+            raise BasicError("Operand type mismatch.")
+        # the bits of an int result are only looked at when it is an int
+        if op == "+":
+            def addValue():
+                value = left() + right()
+                if value.__class__ is int and value.bit_length() > maxIntBits:
+                    return intOverflow(value)
+                return value
+            return addValue, "NUM"
+        elif op == "-":
+            def subtractValue():
+                value = left() - right()
+                if value.__class__ is int and value.bit_length() > maxIntBits:
+                    return intOverflow(value)
+                return value
+            return subtractValue, "NUM"
+        elif op == "*":
+            def multiplyValue():
+                value = left() * right()
+                if value.__class__ is int and value.bit_length() > maxIntBits:
+                    return intOverflow(value)
+                return value
+            return multiplyValue, "NUM"
+        elif op == "/":
+            return (lambda: left() / right()), "NUM"
+        elif op == "^":
+            return (lambda: power(left(), right())), "NUM"
+        elif op == "%":
+            return (lambda: left() % right()), "NUM"
+        elif op == "&":
+            def andValue():
+                value1 = left()
+                value2 = right()
+                return value1 and value2
+            return andValue, "NUM"
+        elif op == "|":
+            def orValue():
+                value1 = left()
+                value2 = right()
+                return value1 or value2
+            return orValue, "NUM"
+        elif op == "<<":
+            return (lambda: shiftLeft(left(), right())), "NUM"
+        elif op == ">>":
+            return (lambda: toInteger(left()) >> toInteger(right())), "NUM"
+
+    def compileProgram(self, limited = False):
+        # a limited program has a TICK before every line and FOR body
+        if self.machine != None and self.machine.limited == limited:
+            return self.machine
+        # every line parsed and compiled at once makes a lot of objects that
+        # all stay, the collector would only walk them over and over again
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.machine = self.emitProgram(limited)
+        finally:
+            if collecting:
+                gc.enable()
+        return self.machine
+
+    def emitProgram(self, limited):
+        for lineNumber in self.runNumbers:
+            if changesProgram(self.getLine(lineNumber).statement):
                 return None
-        return tokens[0]
+        code = []
+        lineStarts = []
+        fixups = []
+        for slot in range(len(self.runNumbers)):
+            lineStarts.append(len(code))
+            if limited:
+                code.append(("TICK", self.runNumbers[slot]))
+            self.emitStatement(self.getLine(self.runNumbers[slot]).statement, code, slot, fixups, limited)
+        lineStarts.append(len(code))
+        code.append(("HALT", None))
+        # GOTO and GOSUB to a constant line were emitted with the slot of the line
+        for position in fixups:
+            op, arg = code[position]
+            if op == "JUMP":
+                code[position] = ("JUMP", lineStarts[arg])
+            else: # and the line it lands on for MEMO
+                target = self.runNumbers[arg[0]] if arg[0] < len(self.runNumbers) else None
+                code[position] = ("GOSUB", (lineStarts[arg[0]], arg[1], target))
+        returnTo = {}
+        for slot in range(len(self.runNumbers)):
+            returnTo[self.runNumbers[slot]] = lineStarts[slot + 1]
+        return Machine(code, lineStarts, returnTo, limited)
 
-def findMatchingClose(tokens, openIndex):
-    openCount = 1
-    for i in range(openIndex + 1, len(tokens)):
-        if tokens[i][0] == "(":
-            openCount += 1
-        elif tokens[i][0] == ")":
-            openCount -= 1
-        if openCount == 0:
-            return i
-    return None
+    def emitStatement(self, statement, code, slot, fixups, limited):
+        # a statement that doesn't compile reports its error when it is reached
+        start = len(code)
+        try:
+            self.emitInstructions(statement, code, slot, fixups, limited)
+        except BasicError as e:
+            del code[start:]
+            fixups[:] = [position for position in fixups if position < start]
+            code.append(("EXEC", (failing(str(e)), slot)))
+
+    def emitInstructions(self, statement, code, slot, fixups, limited):
+        command = statement[0]
+        if command == "REM":
+            return
+        elif command == "END":
+            code.append(("HALT", None))
+        elif command == "PRINT":
+            code.append(("PRINT", self.compileExpression(statement[1])))
+        elif command == "LET" and isinstance(statement[1], str) and not(isAppend(statement[1], statement[2])):
+            value, valueType = self.compileExpression(statement[2])
+            if getVarType(statement[1]) != valueType:
+                raise BasicError(f"Variable {statement[1]} type mismatch.")
+            code.append(("STORE", (self.variableSlot(statement[1]), value)))
+        elif command == "ST":
+            value, valueType = self.compileExpression(statement[2])
+            if valueType != "NUM":
+                raise BasicError("Rigister A expected number.")
+            code.append(("STORE_REGISTER", (statement[1], value)))
+        elif command == "LD" and isinstance(statement[2], str):
+            if getVarType(statement[2]) != "NUM":
+                raise BasicError(f"Variable {statement[2]} is not a number.")
+            code.append(("LOAD_REGISTER", (self.variableSlot(statement[2]), statement[1])))
+        elif command == "GOTO" or command == "GOSUB":
+            tree = statement[1]
+            if tree[0] == "NUM":
+                fixups.append(len(code))
+                if command == "GOTO":
+                    code.append(("JUMP", self.jumpSlot(tree[1])))
+                else:
+                    code.append(("GOSUB", (self.jumpSlot(tree[1]), self.runNumbers[slot])))
+                return
+            lineNumber, lineType = self.compileExpression(tree)
+            if lineType != "NUM": # prints "Line number expected." and carries on
+                code.append(("EXEC", (self.compileLine(statement), slot)))
+            elif command == "GOTO":
+                code.append(("GOTO", lineNumber))
+            else:
+                code.append(("GOSUB_LINE", (lineNumber, self.runNumbers[slot])))
+        elif command == "RETURN":
+            code.append(("RETURN", None))
+        elif command == "IF":
+            branch = len(code)
+            code.append(None)
+            self.emitStatement(statement[2], code, slot, fixups, limited)
+            if statement[3] != None:
+                skipElse = len(code)
+                code.append(None)
+                code[branch] = ("JUMP_IF_FALSE", (self.compileExpression(statement[1])[0], len(code)))
+                self.emitStatement(statement[3], code, slot, fixups, limited)
+                code[skipElse] = ("JUMP", len(code))
+            else:
+                code[branch] = ("JUMP_IF_FALSE", (self.compileExpression(statement[1])[0], len(code)))
+        elif command == "FOR" and (statement[5] == None or staysInLine(statement[5])):
+            varName = statement[1]
+            start, startType = self.compileExpression(statement[2])
+            if getVarType(varName) != startType:
+                raise BasicError(f"Variable {varName} type mismatch.")
+            end, endType = self.compileExpression(statement[3])
+            if endType != "NUM":
+                raise BasicError("Expected number.")
+            step = self.compileStep(statement[4])
+            varSlot = self.variableSlot(varName)
+            if statement[5] == None:
+                code.append(("LOOP", (varSlot, start, end, step, self.runNumbers[slot], slot)))
+                return
+            loop = len(code)
+            code.append(None)
+            if limited:
+                code.append(("TICK", self.runNumbers[slot]))
+            self.emitStatement(statement[5], code, slot, fixups, limited)
+            code.append(("FOR_NEXT", (varSlot, loop + 1)))
+            code[loop] = ("FOR", (varSlot, start, end, step, len(code)))
+            code.append(("FOR_END", varSlot))
+        elif command == "NEXT":
+            varSlot = None
+            if statement[1] != None:
+                varSlot = self.variableSlot(statement[1])
+            code.append(("NEXT", varSlot))
+        else: # everything else runs the closure compiled for the tree walker
+            code.append(("EXEC", (self.compileLine(statement), slot)))
+
+    def runMachine(self, program):
+        code = program.code
+        lineStarts = program.lineStarts
+        scope = self.frame
+        stack = []
+        pc = 0
+        while True:
+            op, arg = code[pc]
+            pc += 1
+            if op == "STORE":
+                scope[arg[0]] = arg[1]()
+            elif op == "JUMP_IF_FALSE":
+                if arg[0]() == 0:
+                    pc = arg[1]
+            elif op == "JUMP":
+                pc = arg
+            elif op == "FOR_NEXT":
+                step = stack[-1]
+                counter = stack[-3] + step
+                stack[-3] = counter
+                scope[arg[0]] = counter
+                if counter <= stack[-2] if step >= 0 else counter >= stack[-2]:
+                    pc = arg[1]
+            elif op == "PRINT":
+                self.printHandler(arg[0](), arg[1])
+            elif op == "STORE_REGISTER":
+                self.registers[arg[0]] = arg[1]()
+            elif op == "LOAD_REGISTER":
+                scope[arg[0]] = self.registers[arg[1]]
+            elif op == "GOSUB" or op == "GOSUB_LINE":
+                if op == "GOSUB":
+                    target = arg[0]
+                    lineNumber = arg[2]
+                else:
+                    slot = self.jumpSlot(arg[0]())
+                    target = lineStarts[slot]
+                    lineNumber = self.runNumbers[slot] if slot < len(self.runNumbers) else None
+                if len(self.memos) != 0 and self.memoCall(lineNumber):
+                    continue
+                self.pushFrame(arg[1]) # push current line number to stack
+                scope = self.frame
+                pc = target
+            elif op == "RETURN":
+                lineNumber = self.popFrame()
+                scope = self.frame
+                pc = program.returnTo.get(lineNumber)
+                if pc == None:
+                    pc = lineStarts[bisect.bisect_right(self.runNumbers, lineNumber)]
+            elif op == "GOTO":
+                pc = lineStarts[self.jumpSlot(arg())]
+            elif op == "FOR":
+                # the saved iterator variable, the counter, the end value and the step
+                varSlot = arg[0]
+                stack.append(scope.get(varSlot, unset))
+                counter = arg[1]()
+                scope[varSlot] = counter
+                endValue = arg[2]()
+                step = 1 if arg[3] == None else arg[3]()
+                stack.append(counter)
+                stack.append(endValue)
+                stack.append(step)
+                if not(counter <= endValue if step >= 0 else counter >= endValue):
+                    pc = arg[4]
+            elif op == "FOR_END":
+                del stack[-3:]
+                # restore the iterator variable
+                iterVar = stack.pop()
+                if iterVar is not unset:
+                    scope[arg] = iterVar
+            elif op == "LOOP":
+                if not(self.forLoop(arg[0], arg[1], arg[2], arg[3], arg[4])):
+                    pc = lineStarts[self.findNext(arg[5] + 1) + 1]
+            elif op == "NEXT":
+                lineNumber = self.nextLoop(arg)
+                if lineNumber != None:
+                    pc = program.returnTo[lineNumber]
+            elif op == "EXEC":
+                # run the statement's own closure, it may jump or stop like in RUN
+                slot = arg[1]
+                self.linePointer = self.runNumbers[slot]
+                self.slotPointer = slot + 1
+                arg[0]()
+                if self.stopExecution:
+                    return
+                if self.slotPointer != slot + 1:
+                    pc = lineStarts[self.slotPointer]
+                scope = self.frame
+            elif op == "TICK":
+                self.linePointer = arg
+                self.ticksLeft -= 1
+                if self.ticksLeft == 0:
+                    self.checkLimits()
+            elif op == "HALT":
+                return
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        sys.exit(runBatch(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "--sweep":
+        sys.exit(runSweep(sys.argv[2:]))
+    if len(sys.argv) > 1: # python tb.py program.tb runs a program and exits
+        sys.exit(runFile(sys.argv[1:]))
     main()